@@ -7,7 +7,7 @@ import os
 
 from colorama import init, Fore, Style
 
-from . import gui, info, irc, modules, users
+from . import fetcher, gui, httpclient, info, irc, modules, users
 
 # section wrapping functions
 # start colorama wrapping
@@ -97,6 +97,8 @@ class Bot:
         self.accounts.add_standard_keys()
         self.info.add_standard_keys(autostart=autostart)
 
+        httpclient.configure(self.settings.get('http', {}))
+
         # load modules
         self.modules.load_init()
 
@@ -105,4 +107,9 @@ class Bot:
         self.irc.add_handler('both', 'all', self.modules.handle)
         self.irc.add_handler('both', 'raw', self.modules.handle)
         self.irc.connect_info(self.info, self.settings)
-        self.irc.run_forever()
+        try:
+            self.irc.run_forever()
+        finally:
+            fetcher.close_fetcher()
+            self.modules.pool.shutdown(timeout=5)
+            info.flush_all()
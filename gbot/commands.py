@@ -5,6 +5,24 @@
 
 from .users import USER_LEVEL_NOPRIVS, USER_LEVEL_ADMIN
 
+# events that change who is in which channel, and so make cached whitelists stale. when
+#   we join a channel, its users come in with the names replies after our join
+whitelist_invalidating_verbs = ('join', 'part', 'kick', 'quit', 'nick', 'namreply',
+                                'endofnames')
+
+# server name -> number of times that server's whitelists have been invalidated
+_whitelist_generations = {}
+
+
+def invalidate_whitelists(server_name):
+    """Mark every command's cached whitelist for the given server as stale."""
+    _whitelist_generations[server_name] = _whitelist_generations.get(server_name, 0) + 1
+
+
+def _ilower(server, name):
+    """Return the given nick or channel name lowercased with the server's casemapping."""
+    return str(server.istring(name).lower())
+
 
 class BaseCommand:
     """Provides for a generic command backend."""
@@ -55,6 +73,34 @@ class Command(BaseCommand):
         if not hasattr(self, 'channel_mode_restriction'):
             self.channel_mode_restriction = None
 
+        # server name -> (generation, channel set, user set)
+        self._whitelist_cache = {}
+
+    def _compile_whitelist(self, server):
+        channels = set()
+        users = set(_ilower(server, user) for user in self.user_whitelist)
+
+        for chan in self.channel_whitelist:
+            channels.add(_ilower(server, chan))
+            for user in server.get_channel_info(server.istring(chan))['users']:
+                users.add(_ilower(server, user))
+
+        return channels, users
+
+    def is_whitelisted(self, server, channel_name, nick):
+        """Returns True if the given channel or nick is allowed to use this command."""
+        if not self.channel_whitelist:
+            return True
+
+        generation = _whitelist_generations.get(server.name, 0)
+        cached = self._whitelist_cache.get(server.name)
+        if cached is None or cached[0] != generation:
+            cached = (generation,) + self._compile_whitelist(server)
+            self._whitelist_cache[server.name] = cached
+
+        generation, channels, users = cached
+        return _ilower(server, channel_name) in channels or _ilower(server, nick) in users
+
 
 class UserCommand:
     """Command from a client."""
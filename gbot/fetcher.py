@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+# Goshu IRC Bot
+# written by Daniel Oaks <daniel@danieloaks.net>
+# licensed under the ISC license
+"""background URL fetcher
+
+Fetches run as coroutines on a single event loop thread, so hundreds of slow lookups can be
+waiting at once without each one tying up a thread. Results are the same as get_url's:
+either an error message string, or a response with `text`, `content` and `status_code`.
+
+Modules should usually use Module.fetch_url, which runs a callback with the result in the
+bot's worker pool.
+
+This uses httpx if it's installed. Without it, fetches fall back to running get_url on a
+few helper threads.
+"""
+
+import asyncio
+import concurrent.futures
+import functools
+import threading
+import urllib.parse
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+from http_status import Status
+
+from .httpclient import (BodyReader, ResponseTooLarge, StreamedResponse, UnsupportedContentType,
+                         check_response_headers, http_client, request_key)
+from .libs.helper import get_url, http_busy_message, http_error_message
+
+# helper threads we use when httpx isn't installed
+default_fallback_workers = 8
+
+
+class AsyncFetcher:
+    """Fetches URLs on a background event loop.
+
+    Settings (timeouts, limits, response cache) come from the shared HttpClient.
+    """
+
+    def __init__(self, client=None, fallback_workers=None):
+        self.client = client or http_client()
+        self.fallback_workers = fallback_workers or default_fallback_workers
+
+        self._loop = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._closed = False
+
+        # only touched from the loop thread
+        self._session = None
+        self._executor = None
+        # host -> [semaphore, fetches using or waiting for it], dropped once unused
+        self._host_slots = {}
+        self._flights = {}
+
+        # counters
+        self.submitted = 0
+        self.shared = 0
+
+    def _start(self):
+        with self._lock:
+            if self._closed:
+                raise Exception('AsyncFetcher has been closed')
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self._run, name='goshu-fetcher',
+                                                daemon=True)
+                self._thread.start()
+        return self._loop
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
+        try:
+            self._loop.run_forever()
+        finally:
+            self._loop.run_until_complete(self._shutdown())
+            self._loop.close()
+
+    async def _shutdown(self):
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        if self._session is not None:
+            await self._session.aclose()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+
+    def submit(self, url, **kwargs):
+        """Start fetching url, returning a concurrent.futures.Future for the result.
+
+        kwargs are the same as get_url's.
+        """
+        loop = self._start()
+        self.submitted += 1
+        return asyncio.run_coroutine_threadsafe(self.fetch(url, **kwargs), loop)
+
+    def submit_all(self, requests, timeout=None):
+        """Start fetching several URLs at once, returning a Future for the list of results.
+
+        requests is a list of (url, kwargs) tuples, and the results are in the same order.
+        Any fetches still running after timeout seconds are cancelled, and their result is
+        'Connection timed out'.
+        """
+        loop = self._start()
+        self.submitted += len(requests)
+        return asyncio.run_coroutine_threadsafe(self.fetch_all(requests, timeout), loop)
+
+    async def fetch_all(self, requests, timeout=None):
+        """Coroutine version of submit_all, for use on our loop."""
+        tasks = [asyncio.ensure_future(self.fetch(url, **kwargs)) for url, kwargs in requests]
+        if not tasks:
+            return []
+
+        done, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+
+        results = []
+        for task in tasks:
+            if task in done and not task.cancelled() and task.exception() is None:
+                results.append(task.result())
+            else:
+                results.append('Connection timed out')
+        return results
+
+    async def fetch(self, url, cache=False, cache_ttl=None, **kwargs):
+        """Coroutine version of get_url, for use on our loop."""
+        if httpx is None:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    self.fallback_workers, thread_name_prefix='goshu-fetcher')
+            return await asyncio.get_running_loop().run_in_executor(
+                self._executor,
+                functools.partial(get_url, url, cache=cache, cache_ttl=cache_ttl, **kwargs))
+
+        key = request_key(url, kwargs)
+
+        if cache:
+            found, r = self.client.cache.get(key)
+            if found:
+                return r
+
+        # share the result of any identical fetch that's already running
+        flight = self._flights.get(key)
+        if flight is not None:
+            self.shared += 1
+            return await asyncio.shield(flight)
+
+        flight = asyncio.get_running_loop().create_future()
+        self._flights[key] = flight
+        try:
+            r = await self._fetch(url, kwargs)
+        except asyncio.CancelledError:
+            # only we were cancelled (say, fetch_all's deadline passed), whoever's sharing
+            #   this fetch still gets an answer
+            flight.set_result('Connection timed out')
+            raise
+        except Exception as x:
+            flight.set_exception(x)
+            flight.exception()  # they'll see it, so no need for asyncio to warn about it
+            raise
+        except BaseException:
+            flight.cancel()
+            raise
+        finally:
+            del self._flights[key]
+
+        if cache:
+            self.client.cache_result(key, r, cache_ttl, failure_ok=r != http_busy_message)
+        flight.set_result(r)
+        return r
+
+    def _get_session(self):
+        if self._session is None:
+            client = self.client
+            self._session = httpx.AsyncClient(
+                follow_redirects=True,
+                timeout=httpx.Timeout(client.timeout, connect=client.connect_timeout,
+                                      pool=client.wait_timeout),
+                limits=httpx.Limits(max_connections=client.async_max_requests,
+                                    max_keepalive_connections=client.max_hosts))
+        return self._session
+
+    async def _fetch(self, url, kwargs):
+        host = urllib.parse.urlsplit(url).netloc.lower()
+        host_slot = self._host_slots.get(host)
+        if host_slot is None:
+            host_slot = [asyncio.Semaphore(self.client.max_per_host), 0]
+            self._host_slots[host] = host_slot
+        host_slot[1] += 1
+        try:
+            return await self._fetch_in_slot(url, kwargs, host_slot[0])
+        finally:
+            host_slot[1] -= 1
+            if not host_slot[1]:
+                del self._host_slots[host]
+
+    async def _fetch_in_slot(self, url, kwargs, slot):
+        try:
+            await asyncio.wait_for(slot.acquire(), self.client.wait_timeout)
+        except asyncio.TimeoutError:
+            return http_busy_message
+
+        try:
+            if kwargs.get('max_bytes') or kwargs.get('content_types') or kwargs.get('stop_at'):
+                r = await self._fetch_streamed(url, kwargs)
+            else:
+                r = await self._get_session().get(url, **kwargs)
+
+        except (ResponseTooLarge, UnsupportedContentType) as x:
+            return str(x)
+
+        except httpx.PoolTimeout:
+            return http_busy_message
+
+        except httpx.TimeoutException:
+            return 'Connection timed out'
+
+        except (httpx.HTTPError, httpx.InvalidURL) as x:
+            return '{}'.format(x.__class__.__name__)
+
+        finally:
+            slot.release()
+
+        r.status = Status(r.status_code)
+        if r.status_code >= 400:
+            return http_error_message(r.status)
+
+        return r
+
+    async def _fetch_streamed(self, url, kwargs):
+        kwargs = dict(kwargs)
+        max_bytes = kwargs.pop('max_bytes', None)
+        content_types = kwargs.pop('content_types', None)
+        stop_at = kwargs.pop('stop_at', None)
+
+        async with self._get_session().stream('GET', url, **kwargs) as r:
+            # error pages aren't worth reading
+            if r.status_code >= 400:
+                return StreamedResponse(str(r.url), r.status_code, r.headers, b'')
+
+            check_response_headers(r.headers, max_bytes, content_types)
+            reader = BodyReader(max_bytes, stop_at)
+            async for chunk in r.aiter_bytes():
+                if reader.feed(chunk):
+                    break
+            return StreamedResponse(str(r.url), r.status_code, r.headers, reader.data,
+                                    stopped=reader.stopped)
+
+    def close(self, timeout=5):
+        """Cancel any running fetches and stop our loop."""
+        with self._lock:
+            self._closed = True
+            loop = self._loop
+        if loop is None:
+            return
+
+        loop.call_soon_threadsafe(loop.stop)
+        self._thread.join(timeout)
+
+
+_fetcher = None
+_fetcher_lock = threading.Lock()
+
+
+def fetcher():
+    """Return our shared AsyncFetcher."""
+    global _fetcher
+    if _fetcher is None:
+        with _fetcher_lock:
+            if _fetcher is None:
+                _fetcher = AsyncFetcher()
+    return _fetcher
+
+
+def close_fetcher():
+    """Close our shared AsyncFetcher, if it's been started."""
+    global _fetcher
+    with _fetcher_lock:
+        old_fetcher = _fetcher
+        _fetcher = None
+
+    if old_fetcher is not None:
+        old_fetcher.close()
@@ -0,0 +1,454 @@
+#!/usr/bin/env python3
+# Goshu IRC Bot
+# written by Daniel Oaks <daniel@danieloaks.net>
+# licensed under the ISC license
+"""shared HTTP client
+
+Everything that fetches URLs should go through the client returned by http_client(), so
+connections to the same host get reused between requests, and one slow or popular site
+can't tie up all of our threads.
+"""
+
+import collections
+import json
+import re
+import threading
+import time
+import urllib.parse
+
+import requests
+import requests.adapters
+
+default_http_settings = {
+    # seconds to wait for a connection, and then for the server to send us data
+    'connect_timeout': 5,
+    'timeout': 20,
+    # requests running at once, in total and to a single host
+    'max_requests': 32,
+    'max_per_host': 4,
+    # seconds to wait for one of the above to free up before giving up
+    'wait_timeout': 10,
+    # number of hosts to keep idle connections open to
+    'max_hosts': 32,
+    # requests the background fetcher runs at once, see gbot.fetcher
+    'async_max_requests': 128,
+    # cached responses to keep, how long to keep them for by default, and how long to
+    #   remember failed requests for
+    'cache_size': 512,
+    'cache_ttl': 300,
+    'cache_fail_ttl': 30,
+    # responses bigger than this many bytes aren't cached
+    'cache_max_item_bytes': 512 * 1024,
+}
+
+# bytes we read from streamed responses at a time
+stream_chunk_size = 16 * 1024
+
+# ports we strip out of URLs when using them as cache keys
+default_ports = {
+    'http': 80,
+    'https': 443,
+}
+
+
+class HttpBusy(requests.exceptions.RequestException):
+    """We couldn't start a request because too many were already running."""
+
+
+class ResponseTooLarge(requests.exceptions.RequestException):
+    """A streamed response was bigger than we're willing to read."""
+
+
+class UnsupportedContentType(requests.exceptions.RequestException):
+    """A streamed response had a Content-Type we weren't asked to accept."""
+
+
+def check_response_headers(headers, max_bytes=None, content_types=None):
+    """Raise if a response with these headers isn't worth reading the body of."""
+    if content_types:
+        content_type = headers.get('content-type', '').split(';')[0].strip().lower()
+        if not any(content_type.startswith(allowed.lower()) for allowed in content_types):
+            raise UnsupportedContentType('Unsupported content type: {}'
+                                         ''.format(content_type or 'none'))
+
+    if max_bytes:
+        try:
+            length = int(headers.get('content-length', 0))
+        except ValueError:
+            length = 0
+        if length > max_bytes:
+            raise ResponseTooLarge('Response too large')
+
+
+class BodyReader:
+    """Collects a streamed response body, up to max_bytes.
+
+    With stop_at (a regex), we stop reading as soon as it's been seen, for example once
+    we've got the page's </title>.
+    """
+
+    def __init__(self, max_bytes=None, stop_at=None):
+        self.max_bytes = max_bytes
+        self.stop_at = re.compile(stop_at.encode('utf-8'), re.I) if stop_at else None
+        self.data = bytearray()
+        self.stopped = False
+        self._searched = 0
+
+    def feed(self, chunk):
+        """Add the given chunk, returning True once we don't need to read any more."""
+        self.data.extend(chunk)
+
+        if self.stop_at is not None:
+            # search a little before the new data, in case the pattern's split over chunks
+            match = self.stop_at.search(self.data, max(0, self._searched - 256))
+            self._searched = len(self.data)
+            if match:
+                del self.data[match.end():]
+                self.stopped = True
+                return True
+
+        if self.max_bytes and len(self.data) > self.max_bytes:
+            raise ResponseTooLarge('Response too large')
+
+        return False
+
+
+class StreamedResponse:
+    """What get_url returns for streamed requests, which looks enough like a Response."""
+
+    def __init__(self, url, status_code, headers, content, stopped=False):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.content = bytes(content)
+        self.stopped = stopped
+
+        self.encoding = None
+        content_type = headers.get('content-type', '')
+        for param in content_type.split(';')[1:]:
+            name, _, value = param.strip().partition('=')
+            if name.lower() == 'charset' and value:
+                self.encoding = value.strip('"\'')
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    @property
+    def text(self):
+        try:
+            return self.content.decode(self.encoding or 'utf-8', errors='replace')
+        except LookupError:
+            return self.content.decode('utf-8', errors='replace')
+
+    def json(self):
+        return json.loads(self.text)
+
+
+def normalize_url(url, params=None):
+    """Return a normalized version of the given URL, for use as a cache key.
+
+    The scheme and host are lowercased, default ports and fragments are removed, and query
+    parameters (including any in params) are sorted.
+    """
+    parts = urllib.parse.urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+
+    netloc = (parts.hostname or '').lower()
+    if parts.port and parts.port != default_ports.get(scheme):
+        netloc += ':{}'.format(parts.port)
+    if parts.username:
+        netloc = '{}@{}'.format(parts.username, netloc)
+
+    query = urllib.parse.parse_qsl(parts.query, keep_blank_values=True)
+    if params:
+        query.extend(params.items() if hasattr(params, 'items') else params)
+    query = urllib.parse.urlencode(sorted((str(k), str(v)) for k, v in query))
+
+    return urllib.parse.urlunsplit((scheme, netloc, parts.path or '/', query, ''))
+
+
+def request_key(url, kwargs):
+    """Return a key for the given get_url request, for caching and sharing responses.
+
+    Other arguments (headers, max_bytes, stop_at and so on) can change what we get back,
+    so they're part of the key too.
+    """
+    other_args = sorted((name, repr(value)) for name, value in kwargs.items() if name != 'params')
+    return normalize_url(url, kwargs.get('params')), tuple(other_args)
+
+
+class ResponseCache:
+    """LRU cache of responses, each of which expires after its own TTL."""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+        # counters
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+
+    def get(self, key):
+        """Return (True, value) if key is cached and hasn't expired, else (False, None)."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return False, None
+
+            expires, value = entry
+            if expires < time.time():
+                del self._entries[key]
+                self.expired += 1
+                self.misses += 1
+                return False, None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return True, value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (time.time() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evicted += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Lets threads making the same call at the same time share a single call's result."""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+        # counters
+        self.calls = 0
+        self.shared = 0
+
+    def do(self, key, func, *args, **kwargs):
+        """Return func(*args, **kwargs), or the result of the call already running for key.
+
+        If that call raises an exception, every thread waiting on it gets the exception.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = _Call()
+                self._calls[key] = call
+                running = False
+                self.calls += 1
+            else:
+                running = True
+                self.shared += 1
+
+        if running:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func(*args, **kwargs)
+        except BaseException as ex:
+            call.error = ex
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+        return call.result
+
+
+class HttpClient:
+    """Makes HTTP requests using keep-alive connection pools, with concurrency limits."""
+
+    def __init__(self, connect_timeout=None, timeout=None, max_requests=None,
+                 max_per_host=None, wait_timeout=None, max_hosts=None, async_max_requests=None,
+                 cache_size=None, cache_ttl=None, cache_fail_ttl=None,
+                 cache_max_item_bytes=None):
+        self.connect_timeout = connect_timeout or default_http_settings['connect_timeout']
+        self.timeout = timeout or default_http_settings['timeout']
+        self.max_requests = max_requests or default_http_settings['max_requests']
+        self.max_per_host = max_per_host or default_http_settings['max_per_host']
+        if wait_timeout is None:
+            wait_timeout = default_http_settings['wait_timeout']
+        self.wait_timeout = wait_timeout
+        self.max_hosts = max_hosts or default_http_settings['max_hosts']
+        self.async_max_requests = (async_max_requests or
+                                   default_http_settings['async_max_requests'])
+
+        if cache_ttl is None:
+            cache_ttl = default_http_settings['cache_ttl']
+        self.cache_ttl = cache_ttl
+        if cache_fail_ttl is None:
+            cache_fail_ttl = default_http_settings['cache_fail_ttl']
+        self.cache_fail_ttl = cache_fail_ttl
+        self.cache_max_item_bytes = (cache_max_item_bytes or
+                                     default_http_settings['cache_max_item_bytes'])
+        self.cache = ResponseCache(cache_size or default_http_settings['cache_size'])
+        self.flights = SingleFlight()
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=self.max_hosts,
+                                                pool_maxsize=self.max_per_host)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._slots = threading.BoundedSemaphore(self.max_requests)
+        # host -> [semaphore, requests using or waiting for it], dropped once unused
+        self._host_slots = {}
+        self._lock = threading.Lock()
+
+        # counters
+        self.requests = 0
+        self.failed = 0
+        self.busy = 0
+
+    @classmethod
+    def from_settings(cls, settings):
+        """Create a client from the given settings dict, as stored in bot.json."""
+        kwargs = {}
+        for key in default_http_settings:
+            if key in settings:
+                kwargs[key] = settings[key]
+        return cls(**kwargs)
+
+    def _use_host_slot(self, host):
+        with self._lock:
+            slot = self._host_slots.get(host)
+            if slot is None:
+                slot = [threading.BoundedSemaphore(self.max_per_host), 0]
+                self._host_slots[host] = slot
+            slot[1] += 1
+        return slot[0]
+
+    def _done_with_host_slot(self, host):
+        with self._lock:
+            slot = self._host_slots[host]
+            slot[1] -= 1
+            if not slot[1]:
+                del self._host_slots[host]
+
+    def request(self, method, url, max_bytes=None, content_types=None, stop_at=None, **kwargs):
+        """Make a request and return the requests.Response, raising on connection errors.
+
+        If any of max_bytes, content_types or stop_at are given, we stream the response and
+        return a StreamedResponse instead, see BodyReader and check_response_headers.
+        """
+        kwargs.setdefault('timeout', (self.connect_timeout, self.timeout))
+        streaming = max_bytes or content_types or stop_at
+
+        if not self._slots.acquire(timeout=self.wait_timeout):
+            self.busy += 1
+            raise HttpBusy('Too many requests running')
+        host = urllib.parse.urlsplit(url).netloc.lower()
+        host_slot = self._use_host_slot(host)
+        try:
+            if not host_slot.acquire(timeout=self.wait_timeout):
+                self.busy += 1
+                raise HttpBusy('Too many requests running to this host')
+            try:
+                self.requests += 1
+                if not streaming:
+                    return self.session.request(method, url, **kwargs)
+
+                with self.session.request(method, url, stream=True, **kwargs) as r:
+                    # error pages aren't worth reading
+                    if r.status_code >= 400:
+                        return StreamedResponse(r.url, r.status_code, r.headers, b'')
+
+                    check_response_headers(r.headers, max_bytes, content_types)
+                    reader = BodyReader(max_bytes, stop_at)
+                    for chunk in r.iter_content(stream_chunk_size):
+                        if reader.feed(chunk):
+                            break
+                    return StreamedResponse(r.url, r.status_code, r.headers, reader.data,
+                                            stopped=reader.stopped)
+            except requests.exceptions.RequestException:
+                self.failed += 1
+                raise
+            finally:
+                host_slot.release()
+        finally:
+            self._done_with_host_slot(host)
+            self._slots.release()
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def cache_result(self, key, result, ttl=None, failure_ok=True):
+        """Cache the given response, or failure message, as get_url returns them.
+
+        Failures are only cached if failure_ok is set, and for no longer than the
+        'cache_fail_ttl' setting.
+        """
+        if ttl is None:
+            ttl = self.cache_ttl
+
+        if isinstance(result, str):
+            if failure_ok and self.cache_fail_ttl:
+                self.cache.set(key, result, min(ttl, self.cache_fail_ttl))
+        elif ttl and len(result.content) <= self.cache_max_item_bytes:
+            self.cache.set(key, result, ttl)
+
+    def stats(self):
+        """Return a dict of our current counters."""
+        return {
+            'requests': self.requests,
+            'failed': self.failed,
+            'busy': self.busy,
+            'hosts': len(self._host_slots),
+            'cache_entries': len(self.cache),
+            'cache_hits': self.cache.hits,
+            'cache_misses': self.cache.misses,
+            'shared_requests': self.flights.shared,
+        }
+
+    def close(self):
+        self.session.close()
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def http_client():
+    """Return our shared HttpClient."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = HttpClient()
+    return _client
+
+
+def configure(settings):
+    """Replace our shared HttpClient with one using the given settings."""
+    global _client
+    with _client_lock:
+        old_client = _client
+        _client = HttpClient.from_settings(settings)
+
+    if old_client is not None:
+        old_client.close()
@@ -3,49 +3,312 @@
 # written by Daniel Oaks <daniel@danieloaks.net>
 # licensed under the ISC license
 
+import atexit
+import contextlib
+import copy
 import hashlib
 import json
 import os
+import threading
+import weakref
 
-from .libs.helper import timedelta_to_string, string_to_timedelta
+from .libs.helper import ReadWriteLock, timedelta_to_string, string_to_timedelta
+from .storage import JsonBackend, SqliteBackend
 from .irc import default_timeout_check_interval, default_timeout_length
 
 
+# stores with changes that haven't been written yet, so we can write them on shutdown
+_write_behind_stores = weakref.WeakSet()
+
+
+def flush_all():
+    """Write out every store that has unsaved changes."""
+    for store in list(_write_behind_stores):
+        store.flush()
+
+atexit.register(flush_all)
+
+
+def migrate_to_sqlite(json_path, sqlite_path=None):
+    """Copy the given JSON store (and its journal) into an SQLite store, returns its path."""
+    if sqlite_path is None:
+        sqlite_path = os.path.splitext(json_path)[0] + '.sqlite'
+
+    store, changes = JsonBackend(json_path).load()
+    if store is None:
+        store = {}
+
+    # replay the journal using a throwaway store
+    json_store = InfoStore.__new__(InfoStore)
+    json_store.path = json_path
+    json_store.store = store
+    json_store._lock = ReadWriteLock()
+    for op, key, value in changes:
+        json_store._replay_change(op, key, value)
+    store.pop('store_journal_seq', None)
+
+    backend = SqliteBackend(sqlite_path)
+    backend.write(store)
+    backend.close()
+
+    return sqlite_path
+
+
 class InfoStore():
-    """Stores and manages general information, settings, etc; to be subclassed."""
+    """Stores and manages general information, settings, etc; to be subclassed.
+
+    By default every change is written straight to disk. If `write_interval` is set (or
+    the bot's `store_write_interval` setting is), changes are instead written behind in
+    the background, at most once every `write_interval` seconds.
+
+    Where it's stored depends on `storage` (or the `store_backend` setting), see
+    gbot.storage for the available backends. With the 'json' backend and `journal` (or the
+    `store_journal` setting) enabled, small changes are appended to a journal file next to
+    our data file rather than rewriting the whole store, and the journal is compacted back
+    into the data file every `journal_max_entries` changes.
+
+    Stores are safe to use from multiple threads. Any number of threads can read at once,
+    changes lock out other readers and writers only while the in-memory store is updated,
+    and writing to disk happens outside that lock. `get` returns copies of dicts and lists,
+    so they're safe to look through while other threads make changes.
+    """
     version = 1
+    write_interval = None
+    storage = None
+    journal = None
+    journal_max_entries = 1000
 
-    def __init__(self, bot, path):
+    def __init__(self, bot, path, write_interval=None, storage=None, journal=None):
         self.bot = bot
         self.path = path
         self.store = {}
+
+        settings = getattr(bot, 'settings', None)
+
+        if write_interval is None:
+            write_interval = self.write_interval
+        if write_interval is None:
+            write_interval = settings.get('store_write_interval', 0) if settings else 0
+        self.write_interval = write_interval
+
+        if storage is None:
+            storage = self.storage
+        if storage is None:
+            storage = settings.get('store_backend', 'json') if settings else 'json'
+        self.storage = storage
+
+        if journal is None:
+            journal = self.journal
+        if journal is None:
+            journal = settings.get('store_journal', False) if settings else False
+        self.journal = journal
+
+        if storage == 'json':
+            self.backend = JsonBackend(path, journal=journal,
+                                       journal_max_entries=self.journal_max_entries)
+        elif storage == 'sqlite':
+            sqlite_path = os.path.splitext(path)[0] + '.sqlite'
+            if not os.path.exists(sqlite_path) and os.path.exists(path):
+                migrate_to_sqlite(path, sqlite_path)
+            self.backend = SqliteBackend(sqlite_path)
+        else:
+            raise Exception('Unknown storage backend {} in InfoStore[{}]'.format(storage, path))
+
+        # readers share _lock, writers to the store get it to themselves. _io_lock is held
+        #   while writing to the backend, so disk writes don't hold up readers or writers
+        self._lock = ReadWriteLock()
+        self._io_lock = threading.Lock()
+        self._dirty = False
+        self._flush_timer = None
+        self._batch_depth = 0
+        # (key path, whether it existed, old value) for each change in the current batch
+        self._undo = []
+
+        # (op, key, value_json) changes we haven't saved yet
+        self._pending_changes = []
+        self._needs_snapshot = False
+
         self.load()
 
     # loading and saving
     def load(self):
         """Load information from our data file."""
-        try:
-            with open(self.path, 'r', encoding='utf-8') as info_file:
-                self.store = json.loads(info_file.read())
-                current_version = self.store.get('store_version', 1)
-                while current_version < self.version:
-                    current_version = self.update_store_version(current_version)
-        except FileNotFoundError:
+        store, changes = self.backend.load()
+        if store is None:
             self.initialize_store()
+            # incremental backends need a base to apply changes to
+            self._needs_snapshot = True
+        else:
+            self.store = store
+
+        for op, key, value in changes:
+            self._replay_change(op, key, value)
+
+        current_version = self.store.get('store_version', 1)
+        while current_version < self.version:
+            current_version = self.update_store_version(current_version)
+
+    def _replay_change(self, op, key, value):
+        """Apply a change loaded from our backend, without saving it again."""
+        try:
+            if op == 'set':
+                self._set(key, value)
+            elif op == 'remove':
+                self._remove(key)
+            elif op == 'append_to':
+                self._append_to(key, value)
+            elif op == 'remove_from':
+                self._remove_from(key, value)
+        except (KeyError, ValueError, TypeError) as ex:
+            print('failed to replay change', op, key, 'for', self.path, ':', ex)
 
     def save(self):
-        """Save information to our data file."""
-        # only save file if we have data
-        if not self.store:
+        """Mark our store as changed, and write it out now or schedule it to be written."""
+        with self._lock.write():
+            # we don't know what changed, so the whole store needs to be written
+            self._needs_snapshot = True
+            self._dirty = True
+        self._schedule_write()
+
+    def _record(self, op, key, value=None):
+        """Note down the given change to our store, call with the write lock held."""
+        if self.backend.incremental:
+            self._pending_changes.append((op, key, json.dumps(value)))
+        else:
+            self._needs_snapshot = True
+        self._dirty = True
+
+    def _schedule_write(self):
+        """Write out or schedule our changes, call without the write lock held."""
+        # written when the outermost batch finishes
+        if self._batch_depth:
             return
 
-        # ensure info file folder exists
-        folder = os.path.dirname(self.path)
-        if folder and not os.path.exists(folder):
-            os.makedirs(folder)
+        if not self.write_interval:
+            self.flush()
+            return
+
+        with self._lock.write():
+            if not self._dirty:
+                return
+            _write_behind_stores.add(self)
+            if self._flush_timer is None:
+                self._flush_timer = threading.Timer(self.write_interval, self.flush)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
 
-        with open(self.path, 'w', encoding='utf-8') as info_file:
-            info_file.write(json.dumps(self.store, sort_keys=True, indent=4))
+    def flush(self):
+        """Write out any unsaved changes right now.
+
+        Inside a batch, changes are written once the batch finishes instead.
+        """
+        # we hold the write lock for the batch, and a timed flush holding _io_lock may be
+        #   waiting for it, so we can't wait for _io_lock here
+        if self._batch_depth and self._lock.is_writing():
+            return
+
+        # only one flush at a time, so changes hit the disk in order
+        with self._io_lock:
+            # grab our changes, holding the write lock as briefly as we can
+            with self._lock.write():
+                if self._flush_timer is not None:
+                    self._flush_timer.cancel()
+                    self._flush_timer = None
+
+                if not self._dirty:
+                    return
+                self._dirty = False
+                _write_behind_stores.discard(self)
+
+                changes = self._pending_changes
+                needs_snapshot = self._needs_snapshot
+                self._pending_changes = []
+                self._needs_snapshot = False
+
+            try:
+                # backends don't look at the store to apply changes, so no lock needed here
+                if not needs_snapshot:
+                    needs_snapshot = not self.backend.apply(changes)
+
+                # readers can carry on while we write, writers wait
+                if needs_snapshot:
+                    with self._lock.read():
+                        # anything changed since we grabbed our changes is in this write
+                        #   too. no writers can get in while we hold the read lock
+                        self._pending_changes = []
+                        self.backend.write(self.store)
+            except BaseException:
+                # try again with everything next time
+                with self._lock.write():
+                    self._needs_snapshot = True
+                    self._dirty = True
+                raise
+
+    def compact(self):
+        """Write our whole store out, replacing any incremental changes."""
+        with self._lock.write():
+            self._needs_snapshot = True
+            self._dirty = True
+        self.flush()
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Group a number of changes together, so they're saved with a single write.
+
+        Other threads can't change the store while the batch is running, and if the batch
+        raises an exception, changes made through our methods are rolled back. flush and
+        compact wait until the batch finishes.
+        """
+        with self._lock.write():
+            if not self._batch_depth:
+                state = (self._dirty, self._needs_snapshot, len(self._pending_changes))
+                self._undo = []
+            self._batch_depth += 1
+            try:
+                yield self
+            except BaseException:
+                if self._batch_depth == 1:
+                    self._rollback()
+                    self._dirty, self._needs_snapshot, pending_count = state
+                    del self._pending_changes[pending_count:]
+                raise
+            finally:
+                self._batch_depth -= 1
+                if not self._batch_depth:
+                    self._undo = []
+
+        self._schedule_write()
+
+    def _remember(self, key):
+        """Save what's at key to undo a failed batch, call with the write lock held."""
+        if not self._batch_depth:
+            return
+
+        parts = list(key) if isinstance(key, (list, tuple)) else [key]
+        base = self.store
+        for i, part in enumerate(parts):
+            if not isinstance(base, dict):
+                return  # the change will fail without touching anything
+            if part not in base:
+                # undoing this removes everything the change creates
+                self._undo.append((parts[:i + 1], False, None))
+                return
+            if i == len(parts) - 1:
+                self._undo.append((parts, True, copy.deepcopy(base[part])))
+                return
+            base = base[part]
+
+    def _rollback(self):
+        """Undo the changes made in the current batch, call with the write lock held."""
+        for parts, existed, value in reversed(self._undo):
+            base = self.store
+            for part in parts[:-1]:
+                base = base[part]
+            if existed:
+                base[parts[-1]] = value
+            else:
+                base.pop(parts[-1], None)
+        self._undo = []
 
     # version updating
     def initialize_store(self):
@@ -83,6 +346,10 @@ class InfoStore():
     # getting and setting
     def has_key(self, key):
         """Returns True if we have the given key in our store."""
+        with self._lock.read():
+            return self._has_key(key)
+
+    def _has_key(self, key):
         base, key = self._split_base_from_key(key)
         if base is None:
             return False
@@ -98,6 +365,13 @@ class InfoStore():
 
     def set(self, key, value, create_base=True):
         """Sets key to value in our store."""
+        with self._lock.write():
+            self._remember(key)
+            self._set(key, value, create_base=create_base)
+            self._record('set', key, value)
+        self._schedule_write()
+
+    def _set(self, key, value, create_base=True):
         # find base
         if isinstance(key, (list, tuple)):
             base = self.store
@@ -113,19 +387,36 @@ class InfoStore():
             base = self.store
 
         base[key] = value
-        self.save()
 
     def get(self, key, default=None):
-        """Returns value from our store, or default if it doesn't exist."""
-        base, key = self._split_base_from_key(key)
-        if base is None:
-            return default
+        """Returns value from our store, or default if it doesn't exist.
+
+        Dicts and lists are copied, so they can be looked through without the lock while
+        other threads change the store. Changes to them need to be set again to be saved.
+        """
+        with self._lock.read():
+            base, key = self._split_base_from_key(key)
+            if base is None:
+                return default
 
-        return base.get(key, default)
+            value = base.get(key, default)
+            if isinstance(value, (dict, list)):
+                value = copy.deepcopy(value)
+            return value
 
     def remove(self, key):
         """Remove the given key from our store."""
-        if not self.has_key(key):
+        with self._lock.write():
+            if not self._has_key(key):
+                return
+
+            self._remember(key)
+            self._remove(key)
+            self._record('remove', key)
+        self._schedule_write()
+
+    def _remove(self, key):
+        if not self._has_key(key):
             return
 
         # find base
@@ -148,17 +439,26 @@ class InfoStore():
         except KeyError:
             pass
 
-        self.save()
-
     def initialize_to(self, key, value):
         """If key is not in our store, set it to value."""
-        if self.has_key(key):
-            return
+        with self._lock.write():
+            if self._has_key(key):
+                return
 
-        self.set(key, value)
+            self._remember(key)
+            self._set(key, value)
+            self._record('set', key, value)
+        self._schedule_write()
 
     def append_to(self, key, value):
         """Append a value to a list in our store."""
+        with self._lock.write():
+            self._remember(key)
+            self._append_to(key, value)
+            self._record('append_to', key, value)
+        self._schedule_write()
+
+    def _append_to(self, key, value):
         # find base
         if isinstance(key, (list, tuple)):
             base = self.store
@@ -176,10 +476,15 @@ class InfoStore():
 
         base[key].append(value)
 
-        self.save()
-
     def remove_from(self, key, value):
         """Remove a value from a list in our store."""
+        with self._lock.write():
+            self._remember(key)
+            self._remove_from(key, value)
+            self._record('remove_from', key, value)
+        self._schedule_write()
+
+    def _remove_from(self, key, value):
         # find base
         if isinstance(key, (list, tuple)):
             base = self.store
@@ -197,8 +502,6 @@ class InfoStore():
 
         base[key].remove(value)
 
-        self.save()
-
     # complex junk
     def add_key(self, value_type, key, prompt, repeating_prompt=None, confirm_prompt=None,
                 default=None, allow_none=False, blank_allowed=False, password=False,
@@ -276,6 +579,9 @@ class BotSettings(InfoStore):
     """Manages basic bot settings."""
     version = 2
 
+    # this is where the store_backend setting lives, so it can't be stored anywhere else
+    storage = 'json'
+
     # version upgrading
     def update_store_version(self, current_version):
         if current_version == 1:
@@ -64,8 +64,8 @@ class IRC:
         if user_nick == our_nick:
             try:
                 server_name = event['server'].name
-                self.bot.info.store['servers'][server_name]['autojoin_channels'].remove(channel)
-                self.bot.info.save()
+                self.bot.info.remove_from(['servers', server_name, 'autojoin_channels'],
+                                          channel)
             except:
                 pass
 
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+# Goshu IRC Bot
+# written by Daniel Oaks <daniel@danieloaks.net>
+# licensed under the ISC license
+"""structured JSON Lines logs, with an index for finding records quickly
+
+Each logfile holds one JSON record per line, for example:
+    {"line": "$c3-$c#chan$c3- ...", "nick": "dan", "ts": 1451606400.0, "verb": "pubmsg"}
+
+where `line` is the formatted, $-escaped line as shown on screen. Next to each logfile is
+an index file (the logfile's path plus '.idx'), which has one JSON line for every block of
+records in the logfile:
+    {"count": 256, "end": 1451609999.2, "length": 40213, "nicks": ["dan", ...],
+     "offset": 0, "start": 1451606400.0}
+
+Readers use the index to skip any blocks outside the time range, or without the nick,
+they're looking for. Records after the last indexed block are always read in full.
+"""
+
+import json
+import os
+
+default_block_records = 256
+
+
+def _record_nick(record):
+    nick = record.get('nick')
+    return nick.lower() if nick else None
+
+
+def load_index(path):
+    """Return the list of index entries for the given logfile."""
+    blocks = []
+    try:
+        index_file = open(path + '.idx', 'r', encoding='utf-8')
+    except FileNotFoundError:
+        return blocks
+
+    with index_file:
+        for line in index_file:
+            try:
+                blocks.append(json.loads(line))
+            except ValueError:
+                break  # partially-written last line
+    return blocks
+
+
+class _Block:
+    """Records in a logfile that haven't been indexed yet."""
+
+    def __init__(self, offset):
+        self.offset = offset
+        self.length = 0
+        self.count = 0
+        self.start = None
+        self.end = None
+        self.nicks = set()
+
+    def add(self, record, size):
+        if self.start is None:
+            self.start = record['ts']
+        self.end = record['ts']
+        self.length += size
+        self.count += 1
+
+        nick = _record_nick(record)
+        if nick:
+            self.nicks.add(nick)
+
+    def index_entry(self):
+        return {
+            'offset': self.offset,
+            'length': self.length,
+            'count': self.count,
+            'start': self.start,
+            'end': self.end,
+            'nicks': sorted(self.nicks),
+        }
+
+
+class JsonLogSink:
+    """Writes structured log records, and keeps their indexes up to date.
+
+    Lines go through the given LogWriter, so they're buffered and written out in the
+    background. We track each file's size ourselves, so nothing else should be writing
+    to these files while we are, and they're never rotated.
+    """
+
+    def __init__(self, log_writer, block_records=None):
+        self.log_writer = log_writer
+        self.block_records = block_records or default_block_records
+
+        # path -> _Block that's currently being filled
+        self._blocks = {}
+
+    def _block(self, path):
+        block = self._blocks.get(path)
+        if block is not None:
+            return block
+
+        # pick up where the index leaves off, reading any records from after it
+        blocks = load_index(path)
+        offset = blocks[-1]['offset'] + blocks[-1]['length'] if blocks else 0
+        block = _Block(offset)
+
+        try:
+            log_file = open(path, 'rb')
+        except FileNotFoundError:
+            pass
+        else:
+            with log_file:
+                log_file.seek(offset)
+                for line in log_file:
+                    try:
+                        block.add(json.loads(line.decode('utf-8')), len(line))
+                    except ValueError:
+                        block.length += len(line)
+
+                    # finish off a partially-written last line, from a crash mid-write
+                    if not line.endswith(b'\n'):
+                        block.length += 1
+                        self.log_writer.write(path, '', rotate=False)
+
+        self._blocks[path] = block
+        return block
+
+    def write(self, path, record):
+        """Write the given record (a dict with at least a 'ts' key) to the file at path."""
+        line = json.dumps(record, sort_keys=True)
+        block = self._block(path)
+        block.add(record, len(line) + 1)  # ascii-only json, so characters == bytes
+        self.log_writer.write(path, line, rotate=False)
+
+        if block.count >= self.block_records:
+            self._finish_block(path)
+
+    def _finish_block(self, path):
+        block = self._blocks.pop(path)
+        if block.count:
+            self.log_writer.write(path + '.idx', json.dumps(block.index_entry(), sort_keys=True),
+                                  rotate=False)
+            self._blocks[path] = _Block(block.offset + block.length)
+
+    def close(self):
+        """Index any partly-filled blocks, so readers don't need to read them in full."""
+        for path in list(self._blocks):
+            self._finish_block(path)
+        self._blocks = {}
+
+
+class JsonLogReader:
+    """Reads records back out of a structured logfile."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def records(self, start=None, end=None, nick=None):
+        """Yield records from our logfile in order, optionally filtered.
+
+        Args:
+            start: Only records at or after this unix timestamp.
+            end: Only records before this unix timestamp.
+            nick: Only records from this nick (case-insensitive).
+        """
+        if nick:
+            nick = nick.lower()
+
+        blocks = load_index(self.path)
+        indexed_end = blocks[-1]['offset'] + blocks[-1]['length'] if blocks else 0
+
+        try:
+            log_file = open(self.path, 'rb')
+        except FileNotFoundError:
+            return
+
+        with log_file:
+            for block in blocks:
+                if start is not None and block['end'] < start:
+                    continue
+                if end is not None and block['start'] >= end:
+                    break
+                if nick and nick not in block['nicks']:
+                    continue
+
+                log_file.seek(block['offset'])
+                data = log_file.read(block['length'])
+                yield from self._filter(data.splitlines(), start, end, nick)
+
+            # records that aren't indexed yet
+            log_file.seek(indexed_end)
+            yield from self._filter(log_file, start, end, nick)
+
+    def _filter(self, lines, start, end, nick):
+        for line in lines:
+            try:
+                record = json.loads(line.decode('utf-8'))
+            except ValueError:
+                continue  # partially-written last line
+
+            if start is not None and record['ts'] < start:
+                continue
+            if end is not None and record['ts'] >= end:
+                continue
+            if nick and _record_nick(record) != nick:
+                continue
+            yield record
@@ -14,26 +14,37 @@ elsewhere.
 """
 
 import collections.abc
+import contextlib
 import datetime
+import hashlib
 import imp
 import json
 import os
 import re
+import stat
 import string
 import sys
+import threading
+import time
 import urllib.parse
 
 from girc.formatting import escape
 from http_status import Status
+from lxml import etree
 from pyquery import PyQuery as pq
 import importlib
 import requests
 import xml.sax.saxutils as saxutils
 import yaml
 
+from ..httpclient import (HttpBusy, ResponseTooLarge, UnsupportedContentType, http_client,
+                          request_key)
+
 
 valid_filename_chars = string.ascii_letters + string.digits + '#._- '
 
+http_busy_message = 'Too many requests, try again later'
+
 
 def true_or_false(in_str):
     """Returns True/False if string represents it, else None."""
@@ -194,24 +205,64 @@ def metric(num, metric_list=[[10 ** 9, 'B'], [10 ** 6, 'M'], [10 ** 3, 'k']], ad
     return output
 
 
-def get_url(url, **kwargs):
-    """Gets a url, handles all the icky requests stuff."""
+def get_url(url, cache=False, cache_ttl=None, **kwargs):
+    """Gets a url, handles all the icky requests stuff.
+
+    With cache, responses are cached by URL for cache_ttl seconds (by default, the
+    'cache_ttl' http setting), and failures for the 'cache_fail_ttl' http setting.
+
+    If the same request is already running in another thread, we wait for it and return
+    its response instead of making our own.
+
+    Passing max_bytes, content_types (a list of allowed Content-Type prefixes) or stop_at
+    (a regex, for example '</title>') streams the response, so we don't download more
+    than we need. See HttpClient.request.
+    """
+    client = http_client()
+    key = request_key(url, kwargs)
+
+    if cache:
+        found, r = client.cache.get(key)
+        if found:
+            return r
+
+    return client.flights.do(key, _get_url_and_cache, client, key, url, cache, cache_ttl, kwargs)
+
+
+def _get_url_and_cache(client, key, url, cache, cache_ttl, kwargs):
+    r = _get_url(client, url, **kwargs)
+    if cache:
+        # being busy is our problem, not theirs
+        client.cache_result(key, r, cache_ttl, failure_ok=r != http_busy_message)
+    return r
+
+
+def http_error_message(status):
+    """Return the message get_url gives for the given http_status.Status."""
+    return 'HTTP Error - {code} {name} - {description}'.format(**{
+        'code': status.code,
+        'name': status.name,
+        'description': status.description
+    })
+
+
+def _get_url(client, url, **kwargs):
     try:
-        if 'timeout' not in kwargs:
-            kwargs['timeout'] = 20
-        r = requests.get(url, **kwargs)
+        r = client.get(url, **kwargs)
         r.status = Status(r.status_code)
 
         if not r.ok:
-            return 'HTTP Error - {code} {name} - {description}'.format(**{
-                'code': r.status.code,
-                'name': r.status.name,
-                'description': r.status.description
-            })
+            return http_error_message(r.status)
 
     except requests.exceptions.Timeout:
         return 'Connection timed out'
 
+    except HttpBusy:
+        return http_busy_message
+
+    except (ResponseTooLarge, UnsupportedContentType) as x:
+        return str(x)
+
     except requests.exceptions.RequestException as x:
         return '{}'.format(x.__class__.__name__)
 
@@ -219,43 +270,251 @@ def get_url(url, **kwargs):
 
 
 def format_extract(format_json, input_element, format=None, debug=False, fail='Failure'):
-    if not format:
-        if 'format' in format_json:
-            format = format_json['format']
-        else:
+    """Extract info from the given response body and format it, using format_json's rules.
+
+    The rules are compiled into an ExtractPlan the first time we see format_json.
+    """
+    return extract_plan(format_json).extract(input_element, format=format, debug=debug,
+                                             fail=fail)
+
+
+# id(format_json) -> (format_json, ExtractPlan)
+_extract_plans = {}
+_extract_plans_lock = threading.Lock()
+max_extract_plans = 1024
+
+
+def extract_plan(format_json):
+    """Return the compiled ExtractPlan for format_json, compiling it if we need to.
+
+    Modules should call this when they load their json, so that work's done up-front.
+    """
+    with _extract_plans_lock:
+        cached = _extract_plans.get(id(format_json))
+        if cached is not None and cached[0] is format_json:
+            return cached[1]
+
+        # old plans hang around after their json's been reloaded, so clear them out
+        if len(_extract_plans) >= max_extract_plans:
+            _extract_plans.clear()
+
+        plan = ExtractPlan(format_json)
+        _extract_plans[id(format_json)] = (format_json, plan)
+        return plan
+
+
+def json_path(query):
+    """Compile a query (a list of keys and indexes), returning a lookup(data, default)."""
+    steps = tuple((element, isinstance(element, int)) for element in query)
+
+    def lookup(input_dict, default=None):
+        for element, is_int in steps:
+            if (is_int and isinstance(input_dict, (list, tuple))) or element in input_dict:
+                input_dict = input_dict[element]
+            else:
+                return default
+        return input_dict
+    return lookup
+
+
+def _compile_json_selector(selector):
+    kind = selector[0]
+    if kind == 'text':
+        value = selector[1]
+        return lambda input_json: value
+    elif kind == 'text.escape':
+        value = escape(selector[1])
+        return lambda input_json: value
+
+    path = json_path(selector[1])
+
+    if kind == 'json.lower':
+        default = selector[2] if len(selector) > 2 else ''
+        return lambda input_json: str(path(input_json, default)).lower()
+    elif kind == 'json.quote_plus':
+        default = selector[2] if len(selector) > 2 else ''
+        return lambda input_json: urllib.parse.quote_plus(str(path(input_json, default)))
+    elif kind == 'json.num.metric':
+        default = selector[2] if len(selector) > 2 else 0
+        return lambda input_json: metric(int(path(input_json, default)))
+    elif kind == 'json.datetime.fromtimestamp':
+        default = selector[2] if len(selector) > 2 else 0
+        return lambda input_json: datetime.datetime.fromtimestamp(
+            path(input_json, default)).strftime(selector[2])
+    elif kind == 'json.dict.returntrue':
+        def returntrue(input_json):
+            json_dict = path(input_json)
+            return selector[2].join([key for key in json_dict if json_dict[key]])
+        return returntrue
+    else:
+        default = selector[2] if len(selector) > 2 else None
+        return lambda input_json: escape(str(path(input_json, default)))
+
+
+# used to turn jquery selectors into xpath, the same way pyquery does
+_xpath_translator = pq('<xml/>')
+
+
+def _compile_xml_selector(selector):
+    kind = selector[0]
+    if kind == 'text':
+        value = selector[1]
+        return lambda input_xml: value
+    elif kind == 'text.escape':
+        value = escape(selector[1])
+        return lambda input_xml: value
+    elif kind not in ('jquery', 'jquery.attr'):
+        return lambda input_xml: None
+
+    xpath = etree.XPath(_xpath_translator._css_to_xpath(selector[1]))
+
+    def select(input_xml):
+        elements = []
+        for element in input_xml:
+            elements.extend(xpath(element))
+        return pq(elements)
+
+    if kind == 'jquery':
+        return lambda input_xml: select(input_xml).text()
+    else:
+        return lambda input_xml: select(input_xml).attr(selector[2])
+
+
+# types of ExtractPlan field
+FIELD_CALLABLE = 'callable'
+FIELD_SELECTOR = 'selector'
+FIELD_ERROR = 'error'
+FIELD_EMPTY = 'empty'
+
+
+class ExtractPlan:
+    """format_extract rules for a provider, compiled ahead of time.
+
+    Each response is parsed just once (json.loads, or pyquery for xml), and every field in
+    response_dict is then pulled from that parsed version. We keep track of how long each
+    stage takes, see stats().
+
+    stream_until is a regex that, once it's been seen in a response, means we've got
+    everything we need from it. It comes from the json's 'stream_until' value, or is
+    '</title>' if we only look at the page title.
+    """
+
+    def __init__(self, format_json):
+        self.format_json = format_json
+        self.format = format_json.get('format')
+        self.debug = format_json.get('debug')
+
+        self.stream_until = format_json.get('stream_until')
+        response_dict = format_json.get('response_dict', {})
+        if self.stream_until is None and self.format == 'xml' and response_dict:
+            title_only = True
+            for selector in response_dict.values():
+                if isinstance(selector, collections.abc.Callable):
+                    title_only = False
+                elif selector[0] in ('jquery', 'jquery.attr') and selector[1].strip() != 'title':
+                    title_only = False
+            if title_only:
+                self.stream_until = '</title>'
+
+        # name -> (FIELD_* type, callable/compiled getter/exception)
+        self.fields = {}
+        for name, selector in format_json.get('response_dict', {}).items():
+            if isinstance(selector, collections.abc.Callable):
+                self.fields[name] = (FIELD_CALLABLE, selector)
+            elif self.format not in ('json', 'xml'):
+                self.fields[name] = (FIELD_EMPTY, None)
+            else:
+                try:
+                    if self.format == 'json':
+                        getter = _compile_json_selector(selector)
+                    else:
+                        getter = _compile_xml_selector(selector)
+                    self.fields[name] = (FIELD_SELECTOR, getter)
+                except Exception as ex:
+                    # we'll fail on this one when it's actually used, same as we used to
+                    self.fields[name] = (FIELD_ERROR, ex)
+
+        # counters
+        self.runs = 0
+        self.timings = {
+            'parse': 0.0,
+            'select': 0.0,
+            'format': 0.0,
+        }
+        self.last_timings = {}
+
+    def extract(self, input_element, format=None, debug=False, fail='Failure'):
+        format = format or self.format
+        if not format:
             return 'No format for format_extract()'
+        elif format != self.format:
+            plan = ExtractPlan(dict(self.format_json, format=format))
+            return plan.extract(input_element, debug=debug, fail=fail)
+
+        if self.debug is not None:
+            debug = self.debug
+
+        timings = {}
+        started = time.perf_counter()
+
+        # format-specific settings
+        if format == 'json':
+            input_element = json.loads(input_element)
+            parsed = input_element
+        elif format == 'xml':
+            # ignore xml namespaces
+            input_element = input_element.replace(' xmlns:', ' xmlnamespace:')
+            input_element = input_element.replace(' xmlns=', ' xmlnamespace=')
+            if any(field[0] == FIELD_SELECTOR for field in self.fields.values()):
+                parsed = pq(input_element)
+            else:
+                parsed = None
+        else:
+            parsed = None
 
-    if 'debug' in format_json:
-        debug = format_json['debug']
+        # format extraction - format kwargs
+        parse_done = time.perf_counter()
+        timings['parse'] = parse_done - started
+
+        try:
+            format_dict = self._select(format, input_element, parsed, debug, fail)
+        finally:
+            select_done = time.perf_counter()
+            timings['select'] = select_done - parse_done
+
+        if isinstance(format_dict, str):
+            response = format_dict
+        else:
+            response = self._format(format_dict, debug, fail)
+        timings['format'] = time.perf_counter() - select_done
 
-    # format-specific settings
-    if format == 'json':
-        input_element = json.loads(input_element)
-        retrieve = json_return
-    elif format == 'xml':
-        # ignore xml namespaces
-        input_element = input_element.replace(' xmlns:', ' xmlnamespace:')
-        input_element = input_element.replace(' xmlns=', ' xmlnamespace=')
-        retrieve = xml_return
+        self.runs += 1
+        for stage, duration in timings.items():
+            self.timings[stage] += duration
+        self.last_timings = timings
 
-    # format extraction - format kwargs
-    format_dict = {}
+        return response
 
-    if 'response_dict' in format_json:
-        for name in format_json['response_dict']:
+    def _select(self, format, input_element, parsed, debug, fail):
+        """Return the format kwargs, or a string if something failed."""
+        format_dict = {}
+
+        for name, (field_type, value) in self.fields.items():
             try:
-                if isinstance(format_json['response_dict'][name], collections.abc.Callable):
+                if field_type == FIELD_CALLABLE:
                     try:
-                        format_dict[name] = format_json['response_dict'][name](format_json,
-                                                                               input_element)
+                        format_dict[name] = value(self.format_json, input_element)
                     except BaseException as x:
                         if debug:
                             return 'Unknown failure: {}'.format(x)
                         else:
                             return 'Code error'
+                elif field_type == FIELD_SELECTOR:
+                    format_dict[name] = value(parsed)
+                elif field_type == FIELD_ERROR:
+                    raise value
                 else:
-                    format_dict[name] = retrieve(input_element,
-                                                 format_json['response_dict'][name])
+                    format_dict[name] = None
 
                 if format_dict[name] is None:
                     return fail
@@ -270,89 +529,30 @@ def format_extract(format_json, input_element, format=None, debug=False, fail='F
                 else:
                     return fail
 
-    try:
-        return format_json['response'].format(**format_dict)
-    except KeyError:
-        if debug:
-            return 'Fail on format() key'
-        else:
-            return fail
-    except IndexError:
-        if debug:
-            return 'Fail on format() index'
-        else:
-            return fail
-
-
-def xml_return(input_xml, selector):
-    pq_xml = pq(input_xml)
-
-    if selector[0] == 'text':
-        return selector[1]
-    elif selector[0] == 'text.escape':
-        return escape(selector[1])
-    elif selector[0] == 'jquery':
-        return pq_xml(selector[1]).text()
-    elif selector[0] == 'jquery.attr':
-        return pq_xml(selector[1]).attr(selector[2])
-
-
-def json_return(input_json, selector):
-    if selector[0] == 'text':
-        return selector[1]
-    elif selector[0] == 'text.escape':
-        return escape(selector[1])
-    elif selector[0] == 'json.lower':
-        if len(selector) > 2:
-            default = selector[2]
-        else:
-            default = ""
-        return str(json_element(input_json, selector[1], default=default)).lower()
-    elif selector[0] == 'json.quote_plus':
-        if len(selector) > 2:
-            default = selector[2]
-        else:
-            default = ""
-        return urllib.parse.quote_plus(str(json_element(input_json, selector[1],
-                                                        default=default)))
-    elif selector[0] == 'json.num.metric':
-        if len(selector) > 2:
-            default = selector[2]
-        else:
-            default = 0
-        return metric(int(json_element(input_json, selector[1], default=default)))
-    elif selector[0] == 'json.datetime.fromtimestamp':
-        if len(selector) > 2:
-            default = selector[2]
-        else:
-            default = 0
-        ts = json_element(input_json, selector[1], default=default)
-        return datetime.datetime.fromtimestamp(ts).strftime(selector[2])
-    elif selector[0] == 'json.dict.returntrue':
-        keys = []
-        json_dict = json_element(input_json, selector[1])
-        for key in json_dict:
-            if json_dict[key]:
-                keys.append(key)
-        return selector[2].join(keys)
-    # before general json
-    else:
-        if len(selector) > 2:
-            default = selector[2]
-        else:
-            default = None
-        return escape(str(json_element(input_json, selector[1], default=default)))
+        return format_dict
 
+    def _format(self, format_dict, debug, fail):
+        try:
+            return self.format_json['response'].format(**format_dict)
+        except KeyError:
+            if debug:
+                return 'Fail on format() key'
+            else:
+                return fail
+        except IndexError:
+            if debug:
+                return 'Fail on format() index'
+            else:
+                return fail
 
-def json_element(input_dict, query, default=None):
-    """Runs through a data structure and returns the selected element."""
-    for element in query:
-        is_list_index = isinstance(element, int) and isinstance(input_dict, (list, tuple))
-        if is_list_index or element in input_dict:
-            input_dict = input_dict[element]
-        else:
-            return default
-    return input_dict
+    def stats(self):
+        """Return how many responses we've handled, and the time spent on each stage."""
+        stats = {
+            'runs': self.runs,
+        }
+        for stage, duration in self.timings.items():
+            stats[stage + '_seconds'] = duration
+        return stats
 
 
 def filename_escape(unsafe, replace_char='_', valid_chars=valid_filename_chars):
@@ -392,13 +592,180 @@ def html_unescape(input):
     return output
 
 
+def write_atomically(path, data, encoding='utf-8'):
+    """Write data to the given file so that it's never left half-written.
+
+    We write to a temporary file in the same folder, fsync it, then rename it over the
+    original, so after a crash the file holds either the old or the new contents. The new
+    file keeps the original's permissions.
+    """
+    folder = os.path.dirname(path)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder)
+
+    try:
+        mode = stat.S_IMODE(os.stat(path).st_mode)
+    except FileNotFoundError:
+        mode = None
+
+    tmp_path = '{}.{}-{}.tmp'.format(path, os.getpid(), threading.get_ident())
+    try:
+        with open(tmp_path, 'w', encoding=encoding) as tmp_file:
+            # before writing anything, so it's never readable by anyone it shouldn't be
+            if mode is not None:
+                os.chmod(tmp_path, mode)
+            tmp_file.write(data)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    # make sure the rename itself hits the disk
+    if hasattr(os, 'O_DIRECTORY'):
+        dir_fd = os.open(folder or '.', os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+class ReadWriteLock:
+    """Lets many threads read at once, or a single thread write.
+
+    Waiting writers go before new readers so they don't get starved. Both kinds of lock
+    can be taken again by a thread that already holds them, and a thread holding the
+    write lock can also take the read lock, but a reader can't upgrade to a writer.
+
+    Use as:  with lock.read():  /  with lock.write():
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = None
+        self._writer_depth = 0
+        self._writers_waiting = 0
+        self._local = threading.local()
+
+    def acquire_read(self):
+        depth = getattr(self._local, 'reads', 0)
+        with self._cond:
+            if not depth and self._writer != threading.get_ident():
+                while self._writer is not None or self._writers_waiting:
+                    self._cond.wait()
+            self._readers += 1
+        self._local.reads = depth + 1
+
+    def release_read(self):
+        self._local.reads -= 1
+        with self._cond:
+            self._readers -= 1
+            if not self._readers:
+                self._cond.notify_all()
+
+    def acquire_write(self):
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer == me:
+                self._writer_depth += 1
+                return
+
+            self._writers_waiting += 1
+            while self._writer is not None or self._readers:
+                self._cond.wait()
+            self._writers_waiting -= 1
+            self._writer = me
+            self._writer_depth = 1
+
+    def release_write(self):
+        with self._cond:
+            self._writer_depth -= 1
+            if not self._writer_depth:
+                self._writer = None
+                self._cond.notify_all()
+
+    def is_writing(self):
+        """Return True if the current thread holds the write lock."""
+        return self._writer == threading.get_ident()
+
+    @contextlib.contextmanager
+    def read(self):
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextlib.contextmanager
+    def write(self):
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+
+
 def utf8_bom(input):
     """Strips BOM from a utf8 string, because open() leaves it in for some reason."""
     output = input.replace('\ufeff', '')
     return output
 
 
+class JsonDiff:
+    """What's changed in a JsonHandler's json since it was last loaded.
+
+    added and changed map names to their new info, removed is a list of names.
+    """
+
+    def __init__(self, added=None, changed=None, removed=None):
+        self.added = added or {}
+        self.changed = changed or {}
+        self.removed = removed or []
+
+    def __bool__(self):
+        return bool(self.added or self.changed or self.removed)
+
+    @property
+    def updated(self):
+        """Everything that's been added or changed."""
+        updated = dict(self.added)
+        updated.update(self.changed)
+        return updated
+
+    def __repr__(self):
+        return '<JsonDiff added={} changed={} removed={}>'.format(
+            sorted(self.added), sorted(self.changed), sorted(self.removed))
+
+
+class _JsonFile:
+    """A json/yaml file we've loaded, and how to tell whether it's changed."""
+
+    def __init__(self, stat, py_stat, digest, info):
+        self.stat = stat
+        self.py_stat = py_stat
+        self.digest = digest
+        self.info = info
+
+
+def _file_stat(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+
 class JsonHandler:
+    """Loads json/yaml info files from a folder, and passes them on to a module.
+
+    Files are only read again if they've changed (or, for yaml, their companion .py file
+    has), and the callback gets a JsonDiff of what's different since the last reload,
+    called like callback(new_json, diff).
+    """
+
     def __init__(self, base, folder, attr=None, callback_name=None, ext=None, yaml=False):
         if ext:
             self.pattern = [x.format(ext) for x in ['*.{}.yaml', '*.{}.json', '*_{}.py']]
@@ -411,21 +778,25 @@ class JsonHandler:
         self.callback_name = callback_name
         self.yaml = yaml
 
+        # path -> _JsonFile
+        self._files = {}
+        self.json = None
+
         self.reload()
 
-    def spread_new_json(self, new_json):
+    def spread_new_json(self, new_json, diff=None):
+        if diff is None:
+            diff = JsonDiff(added=dict(new_json))
+
         if self.attr:
             setattr(self.base, self.attr, new_json)
 
         if self.callback_name:
-            getattr(self.base, self.callback_name, None)(new_json)
-
-    def reload(self):
-        new_json = {}
+            getattr(self.base, self.callback_name, None)(new_json, diff)
 
-        if not os.path.exists(self.folder):
-            self.spread_new_json(new_json)
-            return
+    def _find_files(self):
+        """Return (path, name, python module name, python path) for each of our files."""
+        files = []
 
         # loading
         folders_to_scan = [self.folder]
@@ -452,6 +823,7 @@ class JsonHandler:
                     if self.ext:
                         name, ext = os.path.splitext(extname)
                         pyfile = '{}_{}'.format('.'.join(name.split(os.sep)), self.ext)
+                        py_path = '{}_{}{}py'.format(name, self.ext, os.extsep)
 
                         # not really our module
                         if ext != os.extsep + self.ext:
@@ -459,40 +831,103 @@ class JsonHandler:
                     else:
                         name, ext = extname, ''
                         pyfile = '.'.join(name[2:].split(os.sep))
+                        py_path = '{}{}py'.format(name, os.extsep)
 
                     # NOTE: this is static, and that is bad
                     pyfile = pyfile.lstrip('..modules.')
 
-                    # py file
-                    if self.yaml:
-                        try:
-                            module = importlib.import_module(pyfile)
-                            imp.reload(module)  # so reloading works
-                        # we should capture this and output errors to stderr
-                        except:
-                            pass
-
-                    # yaml / json
-                    with open(full_name, encoding='utf-8') as js_f:
-                        if self.yaml:
-                            try:
-                                info = yaml.load(js_f.read(), Loader=yaml.FullLoader)
-                            # we should capture this and output errors to stderr
-                            except Exception as ex:
-                                print('failed to load YAML file', full_name, ':', ex)
-                                continue
-                        else:
-                            info = json.loads(js_f.read())
+                    files.append((full_name, name, pyfile, py_path))
 
-                    # set module name and info
-                    if 'name' not in info:
-                        new_name = name.split('/')[-1].split('\\')[-1]
-                        info['name'] = [new_name]
+        return files
 
-                    new_json[info['name'][0]] = info
+    def _load_file(self, full_name, name, pyfile, data):
+        """Return the info in the given file, or None if it couldn't be loaded."""
+        # py file
+        if self.yaml:
+            try:
+                module = importlib.import_module(pyfile)
+                imp.reload(module)  # so reloading works
+            # we should capture this and output errors to stderr
+            except:
+                pass
+
+        # yaml / json
+        if self.yaml:
+            try:
+                info = yaml.load(data.decode('utf-8'), Loader=yaml.FullLoader)
+            # we should capture this and output errors to stderr
+            except Exception as ex:
+                print('failed to load YAML file', full_name, ':', ex)
+                return None
+        else:
+            info = json.loads(data.decode('utf-8'))
+
+        # set module name and info
+        if 'name' not in info:
+            new_name = name.split('/')[-1].split('\\')[-1]
+            info['name'] = [new_name]
+
+        return info
+
+    def reload(self):
+        new_json = {}
+        files = {}
+
+        if os.path.exists(self.folder):
+            for full_name, name, pyfile, py_path in self._find_files():
+                stat = _file_stat(full_name)
+                py_stat = _file_stat(py_path) if self.yaml else None
+                old_file = self._files.get(full_name)
+
+                # nothing's touched it
+                if old_file is not None and old_file.stat == stat and \
+                        old_file.py_stat == py_stat:
+                    files[full_name] = old_file
+                    new_json[old_file.info['name'][0]] = old_file.info
+                    continue
+
+                try:
+                    with open(full_name, 'rb') as js_f:
+                        data = js_f.read()
+                except FileNotFoundError:
+                    continue
+                digest = hashlib.sha1(data).hexdigest()
+
+                # touched, but not actually changed
+                if old_file is not None and old_file.digest == digest and \
+                        old_file.py_stat == py_stat:
+                    old_file.stat = stat
+                    files[full_name] = old_file
+                    new_json[old_file.info['name'][0]] = old_file.info
+                    continue
+
+                info = self._load_file(full_name, name, pyfile, data)
+                if info is None:
+                    continue
+
+                files[full_name] = _JsonFile(stat, py_stat, digest, info)
+                new_json[info['name'][0]] = info
+
+        # work out what's different
+        old_json = self.json or {}
+        diff = JsonDiff()
+        for name, info in new_json.items():
+            if name not in old_json:
+                diff.added[name] = info
+            elif old_json[name] is not info:
+                diff.changed[name] = info
+        for name in old_json:
+            if name not in new_json:
+                diff.removed.append(name)
+
+        self._files = files
+        first_load = self.json is None
+        self.json = new_json
 
         # set info on base object and / or call callback
-        self.spread_new_json(new_json)
+        if diff or first_load:
+            self.spread_new_json(new_json, diff)
+        return diff
 
 
 # timedelta functions
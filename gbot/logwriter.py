@@ -0,0 +1,436 @@
+#!/usr/bin/env python3
+# Goshu IRC Bot
+# written by Daniel Oaks <daniel@danieloaks.net>
+# licensed under the ISC license
+
+import collections
+import datetime
+import gzip
+import os
+import queue
+import re
+import shutil
+import threading
+import time
+import traceback
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from .workers import OVERFLOW_DROP, OVERFLOW_BLOCK
+
+default_log_writer_settings = {
+    'max_open_files': 32,
+    'flush_interval': 1,
+    'flush_size': 64 * 1024,
+}
+
+default_log_queue_settings = {
+    'max_queue': 10000,
+    'overflow': OVERFLOW_DROP,
+    'block_timeout': 1,
+}
+
+default_log_rotation_settings = {
+    'daily': False,
+    'max_size': 0,
+    'compress': None,
+    'keep_days': 0,
+    'keep_files': 0,
+}
+
+# compression -> extension added to rotated files
+compressed_extensions = {
+    'gzip': '.gz',
+    'zstd': '.zst',
+}
+
+
+class LogWriter:
+    """Buffers lines for our logfiles, and writes them out in the background.
+
+    Lines are written out every `flush_interval` seconds, or sooner once `flush_size`
+    characters are waiting. We keep up to `max_open_files` files open between writes,
+    closing the least recently used ones as we need more.
+
+    If we're given a LogRotator, files are rotated as they're written to, apart from
+    those written to with rotate=False.
+    """
+
+    def __init__(self, max_open_files=None, flush_interval=None, flush_size=None,
+                 encoding='utf-8', rotator=None):
+        self.max_open_files = max_open_files or default_log_writer_settings['max_open_files']
+        self.flush_interval = flush_interval or default_log_writer_settings['flush_interval']
+        self.flush_size = flush_size or default_log_writer_settings['flush_size']
+        self.encoding = encoding
+        self.rotator = rotator
+
+        # path -> list of lines waiting to be written
+        self._buffers = collections.OrderedDict()
+        self._buffered_size = 0
+        self._lock = threading.Lock()
+
+        # path -> open file, least recently used first
+        self._files = collections.OrderedDict()
+        # path -> [day the file's lines are from, size in characters]
+        self._file_state = {}
+        self._known_folders = set()
+        self._no_rotate = set()
+        self._io_lock = threading.Lock()
+
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._closed = False
+
+        # counters
+        self.lines_written = 0
+        self.flushes = 0
+        self.files_opened = 0
+
+    @classmethod
+    def from_settings(cls, settings, **kwargs):
+        """Create a writer from the given settings dict, as stored in bot.json."""
+        for key in default_log_writer_settings:
+            if key in settings:
+                kwargs[key] = settings[key]
+        return cls(**kwargs)
+
+    def write(self, path, line, rotate=True):
+        """Queue the given line to be written to the file at path."""
+        with self._lock:
+            if self._closed:
+                return
+
+            if not rotate:
+                self._no_rotate.add(path)
+            self._buffers.setdefault(path, []).append(line + '\n')
+            self._buffered_size += len(line) + 1
+
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._flusher, name='goshu-log-writer',
+                                                daemon=True)
+                self._thread.start()
+
+            if self._buffered_size >= self.flush_size:
+                self._wakeup.set()
+
+    def _flusher(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+
+            try:
+                self.flush()
+            except Exception:
+                traceback.print_exc()
+
+            if self._closed:
+                return
+
+    def flush(self):
+        """Write out everything that's waiting to be written."""
+        with self._io_lock:
+            with self._lock:
+                buffers = self._buffers
+                self._buffers = collections.OrderedDict()
+                self._buffered_size = 0
+
+            if not buffers:
+                return
+
+            for path, lines in buffers.items():
+                data = ''.join(lines)
+                outfile = self._file(path)
+                state = self._file_state[path]
+
+                if self.rotator and path not in self._no_rotate:
+                    if self.rotator.due(state[0], state[1], len(data)):
+                        self._close_file(path)
+                        try:
+                            self.rotator.rotate(path, state[0])
+                        except OSError:
+                            # keep on writing to the same file
+                            traceback.print_exc()
+                        outfile = self._file(path)
+                        state = self._file_state[path]
+
+                outfile.write(data)
+                outfile.flush()
+                state[1] += len(data)
+                self.lines_written += len(lines)
+            self.flushes += 1
+
+    def _file(self, path):
+        """Return an open file for path, call with the io lock held."""
+        outfile = self._files.get(path)
+        if outfile is not None:
+            self._files.move_to_end(path)
+            return outfile
+
+        folder = os.path.dirname(path)
+        if folder and folder not in self._known_folders:
+            if not os.path.exists(folder):
+                os.makedirs(folder)
+            self._known_folders.add(folder)
+
+        while len(self._files) >= self.max_open_files:
+            self._close_file(next(iter(self._files)))
+
+        outfile = open(path, 'a', encoding=self.encoding)
+        self._files[path] = outfile
+        self.files_opened += 1
+
+        # lines already in the file are from the day it was last written to
+        stat = os.fstat(outfile.fileno())
+        if stat.st_size:
+            day = time.strftime('%Y-%m-%d', time.localtime(stat.st_mtime))
+        else:
+            day = self.rotator.today() if self.rotator else None
+        self._file_state[path] = [day, stat.st_size]
+
+        return outfile
+
+    def _close_file(self, path):
+        self._files.pop(path).close()
+        del self._file_state[path]
+
+    def close(self):
+        """Write out everything that's waiting, and close our files."""
+        with self._lock:
+            self._closed = True
+            thread = self._thread
+        self._wakeup.set()
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+        self.flush()
+        with self._io_lock:
+            for path in list(self._files):
+                self._close_file(path)
+
+        if self.rotator:
+            self.rotator.close()
+
+
+class LogQueue:
+    """Hands log records to a handler, which runs on its own thread.
+
+    Records are handled one at a time, in the order they were put in. Once `max_queue`
+    records are waiting, new ones are either dropped straight away or, with the 'block'
+    overflow policy, we wait up to `block_timeout` seconds for space before dropping them.
+    """
+
+    def __init__(self, handler, max_queue=None, overflow=None, block_timeout=None):
+        self.handler = handler
+        self.max_queue = max_queue or default_log_queue_settings['max_queue']
+        self.overflow = overflow or default_log_queue_settings['overflow']
+        if block_timeout is None:
+            block_timeout = default_log_queue_settings['block_timeout']
+        self.block_timeout = block_timeout
+
+        if self.overflow not in (OVERFLOW_DROP, OVERFLOW_BLOCK):
+            raise Exception('Unknown LogQueue overflow policy: {}'.format(self.overflow))
+
+        self._queue = queue.Queue(self.max_queue)
+        self._thread = None
+        self._thread_lock = threading.Lock()
+        self._closed = False
+
+        # counters
+        self.handled = 0
+        self.failed = 0
+        self.dropped = 0
+
+    @classmethod
+    def from_settings(cls, handler, settings):
+        """Create a queue from the given settings dict, as stored in bot.json."""
+        kwargs = {}
+        for key in default_log_queue_settings:
+            if key in settings:
+                kwargs[key] = settings[key]
+        return cls(handler, **kwargs)
+
+    @property
+    def queue_depth(self):
+        """Number of records waiting to be handled."""
+        return self._queue.qsize()
+
+    def put(self, record):
+        """Queue the given record to be handled, returns False if it was dropped."""
+        if self._closed:
+            self.dropped += 1
+            return False
+
+        if self._thread is None:
+            with self._thread_lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._consumer,
+                                                    name='goshu-log-queue', daemon=True)
+                    self._thread.start()
+
+        try:
+            if self.overflow == OVERFLOW_BLOCK:
+                self._queue.put(record, timeout=self.block_timeout)
+            else:
+                self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+        return True
+
+    def _consumer(self):
+        while True:
+            record = self._queue.get()
+            if record is None:
+                return
+
+            try:
+                self.handler(record)
+            except Exception:
+                self.failed += 1
+                traceback.print_exc()
+            self.handled += 1
+
+    def close(self, timeout=None):
+        """Handle everything that's already been queued, then stop our thread."""
+        self._closed = True
+        with self._thread_lock:
+            thread = self._thread
+        if thread is None:
+            return
+
+        # our marker to stop, after everything that's already queued
+        self._queue.put(None)
+        thread.join(timeout)
+
+
+class LogRotator:
+    """Rotates logfiles daily and/or once they reach a certain size.
+
+    Rotated files are renamed to <path>.<YYYY-MM-DD>, with a .<n> suffix for any after the
+    first on that day, then compressed in the background with gzip or zstd if `compress`
+    is set. Rotated files older than `keep_days` days are removed, as are any past the
+    newest `keep_files` for each logfile.
+    """
+
+    def __init__(self, daily=False, max_size=0, compress=None, keep_days=0, keep_files=0):
+        self.daily = daily
+        self.max_size = max_size
+        self.compress = compress
+        self.keep_days = keep_days
+        self.keep_files = keep_files
+
+        if compress is not None and compress not in compressed_extensions:
+            raise Exception('Unknown LogRotator compression: {}'.format(compress))
+        if compress == 'zstd' and zstandard is None:
+            raise Exception('LogRotator zstd compression needs the zstandard module installed')
+
+        # today's date, and the timestamp when it stops being today
+        self._today = None
+        self._tomorrow_ts = 0
+
+        # compressing and removing old files happens on the queue's thread
+        self._queue = LogQueue(self._process, overflow=OVERFLOW_BLOCK, block_timeout=60)
+
+    @classmethod
+    def from_settings(cls, settings):
+        """Create a rotator from the given settings dict, as stored in bot.json."""
+        kwargs = {}
+        for key in default_log_rotation_settings:
+            if key in settings:
+                kwargs[key] = settings[key]
+        return cls(**kwargs)
+
+    def today(self):
+        """Return today's date, only working it out again once the day changes."""
+        now = time.time()
+        if now >= self._tomorrow_ts:
+            self._today = time.strftime('%Y-%m-%d', time.localtime(now))
+            tomorrow = datetime.date.fromtimestamp(now) + datetime.timedelta(days=1)
+            self._tomorrow_ts = time.mktime(tomorrow.timetuple())
+        return self._today
+
+    def due(self, day, size, new_size):
+        """Return True if a file should be rotated before new_size more is written to it."""
+        if self.daily and size and day != self.today():
+            return True
+        if self.max_size and size and size + new_size > self.max_size:
+            return True
+        return False
+
+    def _segment_exists(self, path):
+        if os.path.exists(path):
+            return True
+        return any(os.path.exists(path + ext) for ext in compressed_extensions.values())
+
+    def rotate(self, path, day):
+        """Move the given (closed) logfile out of the way, returns its new path."""
+        new_path = '{}.{}'.format(path, day)
+        number = 0
+        while self._segment_exists(new_path):
+            number += 1
+            new_path = '{}.{}.{}'.format(path, day, number)
+
+        os.rename(path, new_path)
+        self._queue.put((path, new_path))
+        return new_path
+
+    def _process(self, paths):
+        path, rotated_path = paths
+        if self.compress:
+            self._compress(rotated_path)
+        if self.keep_days or self.keep_files:
+            self.prune(path)
+
+    def _compress(self, path):
+        new_path = path + compressed_extensions[self.compress]
+        tmp_path = new_path + '.tmp'
+
+        with open(path, 'rb') as in_file:
+            if self.compress == 'gzip':
+                with gzip.open(tmp_path, 'wb') as out_file:
+                    shutil.copyfileobj(in_file, out_file, 1024 * 1024)
+            else:
+                with open(tmp_path, 'wb') as out_file:
+                    zstandard.ZstdCompressor().copy_stream(in_file, out_file)
+
+        os.replace(tmp_path, new_path)
+        os.remove(path)
+
+    def segments(self, path):
+        """Return (day, number, path) for each rotated file of the given logfile, oldest first."""
+        folder, name = os.path.split(path)
+        segment_regex = re.compile(re.escape(name) + r'\.(\d{4}-\d\d-\d\d)(?:\.(\d+))?'
+                                   r'(?:\.gz|\.zst)?$')
+
+        segments = []
+        for filename in os.listdir(folder or '.'):
+            match = segment_regex.match(filename)
+            if match:
+                day, number = match.groups()
+                segments.append((day, int(number or 0), os.path.join(folder, filename)))
+        return sorted(segments)
+
+    def prune(self, path):
+        """Remove rotated files of the given logfile that we don't need to keep."""
+        segments = self.segments(path)
+        expired = []
+
+        if self.keep_files and len(segments) > self.keep_files:
+            expired = segments[:-self.keep_files]
+            segments = segments[-self.keep_files:]
+
+        if self.keep_days:
+            oldest_day = datetime.date.today() - datetime.timedelta(days=self.keep_days)
+            oldest_day = oldest_day.strftime('%Y-%m-%d')
+            expired += [segment for segment in segments if segment[0] < oldest_day]
+
+        for day, number, segment_path in expired:
+            os.remove(segment_path)
+
+    def close(self):
+        """Finish compressing and removing files."""
+        self._queue.close()
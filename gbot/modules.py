@@ -7,16 +7,21 @@ import imp
 import importlib
 import inspect
 import json
+import operator
 import os
 import threading
+import traceback
 
 from girc.formatting import escape
 from girc.utils import NickMask
 
-from .commands import AdminCommand, Command, UserCommand, standard_admin_commands
+from .commands import (AdminCommand, Command, UserCommand, standard_admin_commands,
+                       invalidate_whitelists, whitelist_invalidating_verbs)
+from .fetcher import fetcher
 from .info import InfoStore
 from .libs.helper import JsonHandler, add_path
 from .users import user_levels, USER_LEVEL_NOPRIVS, USER_LEVEL_ADMIN
+from .workers import WorkerPool
 
 LISTENER_HIGHEST_PRIORITY = -30
 LISTENER_HIGHER_PRIORITY = -20
@@ -304,6 +309,7 @@ class Module:
             self.reload_json()
 
         self.commands.update(self.static_commands)
+        self.bot.modules.index_commands(self)
 
     def is_ignored(self, target):
         """Whether the target is ignored in our config."""
@@ -324,6 +330,45 @@ class Module:
     def combined(self, event, command, usercommand):
         ...
 
+    def fetch_url(self, url, callback, *args, **kwargs):
+        """Fetch url in the background, then call callback(response, *args) in our worker pool.
+
+        response and kwargs are the same as get_url's, so this is like calling
+        callback(get_url(url, **kwargs), *args), but without holding up a thread while
+        we wait for the server.
+        """
+        future = fetcher().submit(url, **kwargs)
+        future.add_done_callback(self._fetched(callback, args))
+        return future
+
+    def fetch_urls(self, requests, callback, *args, timeout=None):
+        """Fetch several urls at once, then call callback(responses, *args) in our worker pool.
+
+        requests is a list of (url, kwargs) tuples, where kwargs are the same as get_url's,
+        and responses are in the same order. Fetches that take longer than timeout seconds
+        get a 'Connection timed out' response.
+        """
+        future = fetcher().submit_all(requests, timeout=timeout)
+        future.add_done_callback(self._fetched(callback, args))
+        return future
+
+    def _fetched(self, callback, args):
+        def fetched(future):
+            if future.cancelled():
+                return
+            try:
+                result = future.result()
+            except Exception:
+                traceback.print_exc()
+                return
+
+            # we're on the fetcher's loop here, so waiting for space would hold up every
+            #   other fetch
+            if not self.bot.modules.pool.submit(self.name, callback, result, *args, block=False):
+                self.bot.gui.put_line('Dropped fetch result for {}, the worker pool is full or '
+                                      'shutting down'.format(self.name))
+        return fetched
+
     def unload(self):
         pass
 
@@ -371,23 +416,46 @@ class Module:
 
         self.store.add_key(var_type, var_key, prompt, **info)
 
-    def _json_command_callback(self, new_json):
+    def _json_command_callback(self, new_json, diff=None):
         """Update our command dictionary.
         Mixes new json dynamic commands with our static ones.
+
+        With a JsonDiff, only the commands that have been added or changed are rebuilt.
         """
-        # assemble new json dict into actual commands dict
-        new_commands = {}
         disabled_commands = getattr(self.bot, 'settings', {}).get('dynamic_commands_disabled', {}).get(self.name.lower(), [])
+
+        # json key -> commands dict, for each of our json commands
+        json_commands = getattr(self, '_json_commands', {})
+        if diff is None:
+            json_commands = {}
+            updated = new_json
+        else:
+            json_commands = {key: commands for key, commands in json_commands.items()
+                             if key in new_json}
+            updated = diff.updated
+
+        # assemble new json dict into actual commands dict
         for key, info in new_json.items():
             if key in disabled_commands:
+                json_commands.pop(key, None)
+                continue
+
+            # already built, and nothing's changed
+            if key in json_commands and key not in updated:
                 continue
 
-            single_command_dict = self.bot.modules.return_command_dict(self, info)
-            new_commands.update(single_command_dict)
+            json_commands[key] = self.bot.modules.return_command_dict(self, info)
 
             for var_name, var_info in info.get('required_values', {}).items():
                 base_command_name = info['name'][0]
                 self.parse_required_value(base_command_name, var_name, var_info)
+        self._json_commands = json_commands
+
+        new_commands = {}
+        for key in new_json:
+            if key in disabled_commands or key not in json_commands:
+                continue
+            new_commands.update(json_commands[key])
 
         # merge new dynamic commands with static ones
         commands = getattr(self, 'static_commands', {}).copy()
@@ -395,6 +463,12 @@ class Module:
         commands.update(getattr(self, 'static_commands', {}))
 
         self.commands = commands
+        self.bot.modules.index_commands(self)
+
+
+def handler_key(handler, default=None):
+    """Returns the name of the module the given handler belongs to, for the worker pool."""
+    return getattr(getattr(handler, '__self__', None), 'name', default)
 
 
 def isModule(member):
@@ -413,9 +487,25 @@ class Modules:
         add_path(path)
         self.global_admin_commands = {}
 
+        # command name -> [(module name, Command)], sorted by module name, plus commands that
+        #   handle every message ('*'). lists are replaced rather than changed in-place so
+        #   handle_command can read them without locking
+        self.command_index = {}
+        self.wildcard_commands = []
+        self._indexed_commands = {}
+        self._commands_lock = threading.Lock()
+
+        # listeners and commands get run here, replaced in load_init() once we have settings
+        self.pool = WorkerPool()
+
         # event listeners
         self.listeners = {}
 
+        # flattened, priority-ordered (handler, inline, key) tuples for each (direction, verb),
+        #   added as new verbs come in and rebuilt as modules are loaded/unloaded
+        self.dispatch_table = {}
+        self._dispatch_lock = threading.Lock()
+
         # info lists
         self.all_module_names = []
         self.core_module_names = []
@@ -451,6 +541,8 @@ class Modules:
         return modules
 
     def load_init(self):
+        self.pool = WorkerPool.from_settings(self.bot.settings.get('worker_pool', {}))
+
         modules = self._modules_from_path()
         output = 'modules '
         disabled_modules = self.bot.settings.get('disabled_modules', [])
@@ -521,29 +613,35 @@ class Modules:
                 module.events = {}
 
             # add event listeners
-            for direction in ['in', 'out', 'both']:
-                for event_name, handlers in module.events.get(direction, {}).items():
-                    for info in handlers:
-                        if len(info) < 3:
-                            priority, handler = info
-                            inline = False
-                        else:
-                            priority, handler, inline = info
-
-                        if priority not in self.listeners:
-                            self.listeners[priority] = {}
-                        if direction not in self.listeners[priority]:
-                            self.listeners[priority][direction] = {}
-                        if event_name not in self.listeners[priority][direction]:
-                            self.listeners[priority][direction][event_name] = []
-
-                        self.listeners[priority][direction][event_name].append((handler, inline))
+            with self._dispatch_lock:
+                for direction in ['in', 'out', 'both']:
+                    for event_name, handlers in module.events.get(direction, {}).items():
+                        for info in handlers:
+                            if len(info) < 3:
+                                priority, handler = info
+                                inline = False
+                            else:
+                                priority, handler, inline = info
+
+                            if priority not in self.listeners:
+                                self.listeners[priority] = {}
+                            if direction not in self.listeners[priority]:
+                                self.listeners[priority][direction] = {}
+                            if event_name not in self.listeners[priority][direction]:
+                                self.listeners[priority][direction][event_name] = []
+
+                            self.listeners[priority][direction][event_name].append((handler, inline))
+
+                        self._refresh_dispatch(direction, event_name)
 
             for command in module.events.get('commands', {}):
                 self.add_command_info(module.name, command)
             module.folder_path = os.path.join('modules', name)
             module.bot = self.bot
 
+            module.commands.update(module.static_commands)
+            self.index_commands(module)
+
         return True
 
     def unload(self, name):
@@ -559,54 +657,59 @@ class Modules:
                         self.bot.modules.global_admin_commands[cmd].remove(handler)
 
             # remove event listeners
-            for direction in ['both', 'in', 'out']:
-                for event_name, handlers in self.modules[modname].events.get(direction, {}).items():
-                    for info in handlers:
-                        if len(info) < 3:
-                            priority, handler = info
-                            inline = False
-                        else:
-                            priority, handler, inline = info
-
-                        self.listeners[priority][direction][event_name].remove((handler, inline))
-
-                        # clear old dicts if not being used anymore
-                        if not self.listeners[priority][direction][event_name]:
-                            del self.listeners[priority][direction][event_name]
-                        if not self.listeners[priority][direction]:
-                            del self.listeners[priority][direction]
-                        if not self.listeners[priority]:
-                            del self.listeners[priority]
+            with self._dispatch_lock:
+                for direction in ['both', 'in', 'out']:
+                    for event_name, handlers in self.modules[modname].events.get(direction, {}).items():
+                        for info in handlers:
+                            if len(info) < 3:
+                                priority, handler = info
+                                inline = False
+                            else:
+                                priority, handler, inline = info
+
+                            self.listeners[priority][direction][event_name].remove((handler, inline))
+
+                            # clear old dicts if not being used anymore
+                            if not self.listeners[priority][direction][event_name]:
+                                del self.listeners[priority][direction][event_name]
+                            if not self.listeners[priority][direction]:
+                                del self.listeners[priority][direction]
+                            if not self.listeners[priority]:
+                                del self.listeners[priority]
+
+                        self._refresh_dispatch(direction, event_name)
 
             self.modules[modname].unload()
             del self.modules[modname]
+            self.index_commands(modname)
 
         del self.whole_modules[name]
         return True
 
     def handle(self, event):
+        # channel membership changes, so whitelists need to be worked out again
+        if event['verb'] in whitelist_invalidating_verbs:
+            invalidate_whitelists(event['server'].name)
+
         # add source_user_level convenience variable for priv/pubmsg
         if event['verb'] in ('privmsg', 'pubmsg') and event['direction'] == 'in':
             event['source_account'] = self.bot.accounts.account(event['server'], event['source'])
             event['source_user_level'] = self.bot.accounts.access_level(event['source_account'])
 
         # call listeners
-        called = []
-        for priority in sorted(self.listeners.keys()):
-            for search_direction in ['both', event['direction']]:
-                for search_type in ['all', event['verb']]:
-                    for handler, inline in self.listeners[priority].get(search_direction, {}).get(search_type, []):
-                        if handler not in called:
-                            called.append(handler)
-
-                            # if inline, handler can change event as it goes through
-                            #   if they return anything that's not None
-                            if inline:
-                                new_event = handler(event)
-                                if new_event is not None:
-                                    event = new_event
-                            else:
-                                threading.Thread(target=handler, args=[event]).start()
+        handlers = self.dispatch_table.get((event['direction'], event['verb']))
+        if handlers is None:
+            handlers = self._build_dispatch(event['direction'], event['verb'])
+
+        for handler, inline, key in handlers:
+            # if inline, handler can change event as it goes through
+            #   if they return anything that's not None
+            if inline:
+                new_event = handler(event)
+                if new_event is not None:
+                    event = new_event
+            else:
+                self.pool.submit(key, handler, event)
 
         # then handle commands
         if event['verb'] in ('privmsg', 'pubmsg') and event['direction'] == 'in':
@@ -614,6 +717,39 @@ class Modules:
         if event['verb'] == 'privmsg' and event['direction'] == 'in':
             self.handle_admin_command(event)
 
+    def _flatten_listeners(self, direction, verb):
+        """Return priority-ordered (handler, inline, key) tuples for the given direction and verb."""
+        handlers = []
+        called = set()
+        for priority in sorted(self.listeners.keys()):
+            for search_direction in ['both', direction]:
+                for search_type in ['all', verb]:
+                    for handler, inline in self.listeners[priority].get(search_direction, {}).get(search_type, []):
+                        if handler not in called:
+                            called.add(handler)
+                            handlers.append((handler, inline, handler_key(handler)))
+        return tuple(handlers)
+
+    def _build_dispatch(self, direction, verb):
+        """Add the given direction and verb to our dispatch table."""
+        with self._dispatch_lock:
+            handlers = self._flatten_listeners(direction, verb)
+            self.dispatch_table[(direction, verb)] = handlers
+            return handlers
+
+    def _refresh_dispatch(self, direction, event_name):
+        """Rebuild dispatch table entries affected by listeners on the given direction and verb.
+
+        Call with the dispatch lock held.
+        """
+        for table_direction, table_verb in list(self.dispatch_table):
+            if direction not in ('both', table_direction):
+                continue
+            if event_name not in ('all', table_verb):
+                continue
+            handlers = self._flatten_listeners(table_direction, table_verb)
+            self.dispatch_table[(table_direction, table_verb)] = handlers
+
     def handle_admin_command(self, event):
         if event['message'].startswith(escape(self.bot.settings.store['admin_command_prefix'])):
             admin_prefix_len = len(escape(self.bot.settings.store['admin_command_prefix']))
@@ -667,8 +803,8 @@ class Modules:
 
                     args += [event, command_info, usercmd]
 
-                    threading.Thread(target=command_info.call,
-                                     args=args).start()
+                    self.pool.submit(handler_key(command_info.call, module_name),
+                                     command_info.call, *args)
                 else:
                     self.bot.gui.put_line('        No Privs')
 
@@ -692,35 +828,74 @@ class Modules:
             else:
                 userlevel = USER_LEVEL_NOPRIVS
 
+            # same order as walking every module by name, with '*' before the named command
+            candidates = sorted(self.wildcard_commands + self.command_index.get(command_name, []),
+                                key=operator.itemgetter(0))
+
             called = []
-            for module in sorted(self.modules):
-                module_commands = self.modules[module].commands
-                for search_command in ['*', command_name]:
-                    if search_command in module_commands:
-                        command_info = module_commands[search_command]
-                        if userlevel >= command_info.call_level:
-                            # for commands restricted by channel, make and check the priv lists
-                            source_chan = event['target'].name
-                            source_nick = event['source'].nick
-
-                            # if channel_mode_restriction exists, only allow the command to be run in channels
-                            if command_info.channel_mode_restriction and (event['from_to'].is_user or
-                                    (event['from_to'].is_channel and not event['from_to'].has_privs(source_nick, lowest_mode=command_info.channel_mode_restriction))):
-                                continue
-
-                            current_channel_whitelist = [event['server'].istring(chan) for chan in command_info.channel_whitelist]
-                            current_user_whitelist = command_info.user_whitelist
-                            for chan in current_channel_whitelist:
-                                [current_user_whitelist.append(user) for user in event['server'].get_channel_info(chan)['users']]
-
-                            if source_chan in current_channel_whitelist or source_nick in current_user_whitelist or (not current_channel_whitelist):
-                                if command_info.call not in called:
-                                    called.append(command_info.call)
-                                    threading.Thread(target=command_info.call,
-                                                     args=(event, command_info,
-                                                           UserCommand(command_name, command_args))).start()
-                        else:
-                            self.bot.gui.put_line('        No Privs')
+            for module, command_info in candidates:
+                if userlevel >= command_info.call_level:
+                    # for commands restricted by channel, make and check the priv lists
+                    source_chan = event['target'].name
+                    source_nick = event['source'].nick
+
+                    # if channel_mode_restriction exists, only allow the command to be run in channels
+                    if command_info.channel_mode_restriction and (event['from_to'].is_user or
+                            (event['from_to'].is_channel and not event['from_to'].has_privs(source_nick, lowest_mode=command_info.channel_mode_restriction))):
+                        continue
+
+                    if command_info.is_whitelisted(event['server'], source_chan, source_nick):
+                        if command_info.call not in called:
+                            called.append(command_info.call)
+                            self.pool.submit(handler_key(command_info.call, module),
+                                             command_info.call, event, command_info,
+                                             UserCommand(command_name, command_args))
+                else:
+                    self.bot.gui.put_line('        No Privs')
+
+    def index_commands(self, module):
+        """Update the command index with the given module's current commands.
+
+        Args:
+            module: Module object, or the name of a module that has been unloaded
+        """
+        if isinstance(module, str):
+            name = module
+            commands = {}
+        else:
+            name = module.name
+            if self.modules.get(name) is not module:
+                return  # not loaded (yet)
+            commands = dict(module.commands)
+
+        with self._commands_lock:
+            old_commands = self._indexed_commands.pop(name, {})
+            if commands:
+                self._indexed_commands[name] = commands
+
+            # remove old entries
+            for command_name, command in old_commands.items():
+                if command_name == '*':
+                    self.wildcard_commands = [entry for entry in self.wildcard_commands
+                                              if entry[0] != name]
+                    continue
+
+                entries = [entry for entry in self.command_index.get(command_name, [])
+                           if entry[0] != name]
+                if entries:
+                    self.command_index[command_name] = entries
+                else:
+                    self.command_index.pop(command_name, None)
+
+            # add new ones
+            for command_name, command in commands.items():
+                if command_name == '*':
+                    entries = self.wildcard_commands + [(name, command)]
+                    self.wildcard_commands = sorted(entries, key=operator.itemgetter(0))
+                    continue
+
+                entries = self.command_index.get(command_name, []) + [(name, command)]
+                self.command_index[command_name] = sorted(entries, key=operator.itemgetter(0))
 
     def add_command_info(self, module, name):
         info = self.modules[module].events['commands'][name]
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# Goshu IRC Bot
+# written by Daniel Oaks <daniel@danieloaks.net>
+# licensed under the ISC license
+"""rate limiting
+
+A RateLimiter keeps a token bucket for each key. A key is usually a tuple like
+(server, target), but can be anything hashable. Every allowed action takes a token, and
+tokens come back at `rate` per `per` seconds, up to `burst`. Once a key's bucket has
+filled back up, we have nothing worth remembering about it, so it gets dropped.
+"""
+
+import collections
+import threading
+import time
+
+default_rate_limit_settings = {
+    'rate': 1,
+    'per': 15,
+    'burst': 1,
+    # most keys we'll remember, dropping the least recently used after that
+    'max_keys': 10000,
+}
+
+
+class RateLimiter:
+    """Token bucket rate limiter, with a bounded number of self-expiring keys."""
+
+    def __init__(self, rate=None, per=None, burst=None, max_keys=None):
+        self.rate = rate or default_rate_limit_settings['rate']
+        self.per = per or default_rate_limit_settings['per']
+        self.burst = burst or default_rate_limit_settings['burst']
+        self.max_keys = max_keys or default_rate_limit_settings['max_keys']
+
+        if self.rate <= 0 or self.per <= 0 or self.burst < 1:
+            raise Exception('RateLimiter rate and per must be positive, and burst at least 1')
+
+        # seconds for an empty bucket to fill back up
+        self.refill_time = self.burst * self.per / self.rate
+
+        # key -> [tokens, last updated], least recently used first
+        self._buckets = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+        # counters
+        self.allowed = 0
+        self.limited = 0
+        self.expired = 0
+        self.evicted = 0
+
+    @classmethod
+    def from_settings(cls, settings):
+        """Create a limiter from the given settings dict."""
+        kwargs = {}
+        for key in default_rate_limit_settings:
+            if key in settings:
+                kwargs[key] = settings[key]
+        return cls(**kwargs)
+
+    def allow(self, key, cost=1):
+        """Take cost tokens from key's bucket and return True, or return False if it's empty."""
+        now = time.monotonic()
+
+        with self._lock:
+            self._expire(now)
+
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                tokens = self.burst
+            else:
+                tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate / self.per)
+
+            if tokens < cost:
+                self.limited += 1
+                allowed = False
+            else:
+                tokens -= cost
+                self.allowed += 1
+                allowed = True
+
+            self._buckets[key] = [tokens, now]
+            self._buckets.move_to_end(key)
+
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+                self.evicted += 1
+
+        return allowed
+
+    def _expire(self, now):
+        # buckets are in order of when they were last touched, so we only look at the
+        #   ones that've definitely filled back up
+        while self._buckets:
+            key, (tokens, updated) = next(iter(self._buckets.items()))
+            if now - updated < self.refill_time:
+                return
+            del self._buckets[key]
+            self.expired += 1
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def stats(self):
+        """Return a dict of our current counters."""
+        return {
+            'keys': len(self._buckets),
+            'allowed': self.allowed,
+            'limited': self.limited,
+            'expired': self.expired,
+            'evicted': self.evicted,
+        }
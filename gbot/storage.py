@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+# Goshu IRC Bot
+# written by Daniel Oaks <daniel@danieloaks.net>
+# licensed under the ISC license
+"""storage backends for InfoStore
+
+InfoStore keeps its data in memory as a dict, and hands it to one of these backends to
+be saved. Backends that are `incremental` can also save a list of single changes, each
+being an (op, key, value_json) tuple where op is one of 'set', 'remove', 'append_to' or
+'remove_from', instead of rewriting everything.
+
+InfoStore makes sure only one thread calls a backend at a time. `apply` doesn't get to
+see the store, so it can run while other threads are changing it. If it returns False,
+the backend would rather have the whole store written instead.
+"""
+
+import json
+import os
+import sqlite3
+
+from .libs.helper import write_atomically
+
+
+class JsonBackend:
+    """Keeps the store in a single JSON file, optionally with an append-only journal."""
+
+    def __init__(self, path, journal=False, journal_max_entries=1000):
+        self.path = path
+        self.journal_path = path + '.journal'
+        self.journal = journal
+        self.journal_max_entries = journal_max_entries
+
+        self._journal_entries = 0
+        self._journal_seq = 0
+
+    @property
+    def incremental(self):
+        return self.journal
+
+    def load(self):
+        """Return our stored dict (or None if we don't have one) and changes to replay."""
+        try:
+            with open(self.path, 'r', encoding='utf-8') as info_file:
+                store = json.loads(info_file.read())
+        except FileNotFoundError:
+            store = None
+
+        # this is ours, not part of the store
+        self._journal_seq = store.pop('store_journal_seq', 0) if store else 0
+        self._journal_entries = 0
+        changes = []
+
+        try:
+            journal_file = open(self.journal_path, 'r', encoding='utf-8')
+        except FileNotFoundError:
+            return store, changes
+
+        with journal_file:
+            for line in journal_file:
+                try:
+                    seq, op, key, value = json.loads(line)
+                except ValueError:
+                    break  # partially-written last line, from a crash mid-append
+
+                self._journal_entries += 1
+                if seq <= self._journal_seq:
+                    continue  # already in our data file
+                self._journal_seq = seq
+                changes.append((op, key, value))
+
+        return store, changes
+
+    def apply(self, changes):
+        """Append the given changes to our journal, returns False if it needs compacting."""
+        if not changes:
+            return True
+
+        if self._journal_entries + len(changes) > self.journal_max_entries:
+            return False
+
+        lines = []
+        for op, key, value_json in changes:
+            self._journal_seq += 1
+            lines.append('[{}, {}, {}, {}]\n'.format(self._journal_seq, json.dumps(op),
+                                                     json.dumps(key), value_json))
+
+        folder = os.path.dirname(self.journal_path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+
+        with open(self.journal_path, 'a', encoding='utf-8') as journal_file:
+            journal_file.write(''.join(lines))
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+
+        self._journal_entries += len(changes)
+        return True
+
+    def write(self, store):
+        """Write the whole store to our data file, and clear out our journal."""
+        if self.journal or self._journal_entries:
+            store = dict(store, store_journal_seq=self._journal_seq)
+
+        # only save file if we have data
+        if not store:
+            return
+
+        write_atomically(self.path, json.dumps(store, sort_keys=True, indent=4))
+
+        # our data file has everything in the journal now
+        if self._journal_entries:
+            os.remove(self.journal_path)
+            self._journal_entries = 0
+
+    def close(self):
+        pass
+
+
+def _encode_path(parts):
+    return json.dumps([str(part) for part in parts])
+
+
+def _flatten(parts, value):
+    """Yields (path, value_json) rows for every leaf under the given value."""
+    if isinstance(value, dict) and value:
+        for key, child in value.items():
+            yield from _flatten(parts + [key], child)
+    else:
+        yield _encode_path(parts), json.dumps(value)
+
+
+class SqliteBackend:
+    """Keeps the store in an SQLite database, with one row per leaf value.
+
+    Each row's path is the JSON-encoded list of keys leading to it, eg:
+    '["accounts", "dan", "level"]', and lists and empty dicts are stored as single values.
+    Because the encoded path of everything under a key starts with that key's path, minus
+    the closing bracket, we can grab or replace whole subtrees with an indexed range query.
+    """
+    incremental = True
+
+    def __init__(self, path):
+        self.path = path
+        self._db = None
+
+    @property
+    def db(self):
+        if self._db is None:
+            folder = os.path.dirname(self.path)
+            if folder and not os.path.exists(folder):
+                os.makedirs(folder)
+
+            # InfoStore only ever calls us from one thread at a time
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+            self._db.execute('CREATE TABLE IF NOT EXISTS info '
+                             '(path TEXT PRIMARY KEY, value TEXT NOT NULL) WITHOUT ROWID')
+        return self._db
+
+    def load(self):
+        """Return our stored dict (or None if we don't have one) and changes to replay."""
+        if not os.path.exists(self.path):
+            return None, []
+
+        store = {}
+        for path, value in self.db.execute('SELECT path, value FROM info ORDER BY path'):
+            base = store
+            parts = json.loads(path)
+            for key in parts[:-1]:
+                base = base.setdefault(key, {})
+            base[parts[-1]] = json.loads(value)
+
+        return store or None, []
+
+    # path helpers
+    def _delete_tree(self, parts):
+        path = _encode_path(parts)
+        self.db.execute('DELETE FROM info WHERE path = ? OR (path > ? AND path < ?)',
+                        (path, path[:-1] + ', ', path[:-1] + ',!'))
+
+    def _has_children(self, parts):
+        path = _encode_path(parts)
+        row = self.db.execute('SELECT 1 FROM info WHERE path > ? AND path < ? LIMIT 1',
+                              (path[:-1] + ', ', path[:-1] + ',!')).fetchone()
+        return row is not None
+
+    def _get_leaf(self, parts):
+        row = self.db.execute('SELECT value FROM info WHERE path = ?',
+                              (_encode_path(parts), )).fetchone()
+        if row is None:
+            raise KeyError(parts)
+        return json.loads(row[0])
+
+    def _set_tree(self, parts, value):
+        self._delete_tree(parts)
+
+        # parents may have been stored as empty dicts
+        for i in range(1, len(parts)):
+            self.db.execute('DELETE FROM info WHERE path = ?', (_encode_path(parts[:i]), ))
+
+        self.db.executemany('INSERT OR REPLACE INTO info (path, value) VALUES (?, ?)',
+                            _flatten(parts, value))
+
+    def apply(self, changes):
+        """Apply the given changes to our database in a single transaction."""
+        if not changes:
+            return True
+
+        with self.db:
+            for op, key, value_json in changes:
+                if isinstance(key, (list, tuple)):
+                    parts = list(key)
+                else:
+                    parts = [key]
+
+                if op == 'set':
+                    self._set_tree(parts, json.loads(value_json))
+
+                elif op == 'remove':
+                    self._delete_tree(parts)
+
+                    # so the now-empty parent dict still exists after reloading
+                    if len(parts) > 1 and not self._has_children(parts[:-1]):
+                        self._set_tree(parts[:-1], {})
+
+                elif op in ('append_to', 'remove_from'):
+                    value_list = self._get_leaf(parts)
+                    if op == 'append_to':
+                        value_list.append(json.loads(value_json))
+                    else:
+                        value_list.remove(json.loads(value_json))
+                    self._set_tree(parts, value_list)
+
+        return True
+
+    def write(self, store):
+        """Replace everything in our database with the given store."""
+        with self.db:
+            self.db.execute('DELETE FROM info')
+            self.db.executemany('INSERT OR REPLACE INTO info (path, value) VALUES (?, ?)',
+                                _flatten([], store) if store else [])
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+storage_backends = {
+    'json': JsonBackend,
+    'sqlite': SqliteBackend,
+}
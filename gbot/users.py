@@ -108,21 +108,17 @@ class AccountInfo(InfoStore):
         if self.account_exists(name):
             raise Exception('Given account [{}] already exists'.format(name))
 
-        self.store['accounts'][name] = {}
-        self.store['accounts'][name]['password'] = self.encrypt(password)
-
-        self.store['accounts'][name]['modules'] = {}
-
-        self.save()
+        self.set(['accounts', name], {
+            'password': self.encrypt(password),
+            'modules': {},
+        })
 
     def remove_account(self, name):
         """Remove an account from our internal list."""
         if name in self.store['accounts']:
-            del self.store['accounts'][name]
-            self.save()
+            self.remove(['accounts', name])
             return True
         else:
-            self.save()
             return False
 
     def owner_account_exists(self):
@@ -145,8 +141,7 @@ class AccountInfo(InfoStore):
 
     def set_password(self, name, password):
         if self.account_exists(name):
-            self.store['accounts'][name]['password'] = self.encrypt(password)
-            self.save()
+            self.set(['accounts', name, 'password'], self.encrypt(password))
 
     def login(self, name, password, server, user):
         if isinstance(server, str):
@@ -180,10 +175,10 @@ class AccountInfo(InfoStore):
 
     def set_access_level(self, name, level=USER_LEVEL_NOPRIVS):
         if self.account_exists(name):
-            self.store['accounts'][name]['level'] = level
             if level == USER_LEVEL_NOPRIVS:
-                del self.store['accounts'][name]['level']
-            self.save()
+                self.remove(['accounts', name, 'level'])
+            else:
+                self.set(['accounts', name, 'level'], level)
             return True
         return False
 
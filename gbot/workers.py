@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# Goshu IRC Bot
+# written by Daniel Oaks <daniel@danieloaks.net>
+# licensed under the ISC license
+
+import collections
+import threading
+import time
+import traceback
+
+# what to do with new tasks when the queue is full
+OVERFLOW_DROP = 'drop'
+OVERFLOW_BLOCK = 'block'
+
+default_pool_settings = {
+    'max_workers': 16,
+    'max_queue': 512,
+    'module_limit': 4,
+    'overflow': OVERFLOW_DROP,
+    'block_timeout': 2,
+}
+
+
+class WorkerPool:
+    """Bounded pool of worker threads that runs listeners and commands.
+
+    Tasks are tagged with a key (usually the module name), and no more than
+    `module_limit` tasks with the same key run at once. Once `max_queue`
+    tasks are waiting, new ones are either dropped straight away or, with
+    the 'block' overflow policy, we wait up to `block_timeout` seconds for
+    space before dropping them.
+    """
+
+    def __init__(self, max_workers=None, max_queue=None, module_limit=None, overflow=None,
+                 block_timeout=None):
+        self.max_workers = max_workers or default_pool_settings['max_workers']
+        self.max_queue = max_queue or default_pool_settings['max_queue']
+        self.module_limit = module_limit or default_pool_settings['module_limit']
+        self.overflow = overflow or default_pool_settings['overflow']
+        if block_timeout is None:
+            block_timeout = default_pool_settings['block_timeout']
+        self.block_timeout = block_timeout
+
+        if self.overflow not in (OVERFLOW_DROP, OVERFLOW_BLOCK):
+            raise Exception('Unknown WorkerPool overflow policy: {}'.format(self.overflow))
+
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+
+        self._queue = collections.deque()
+        # tasks held back because their key was already at module_limit
+        self._held = {}
+        self._running = collections.Counter()
+
+        self._workers = []
+        self._idle_workers = 0
+        # idle workers we've woken up that haven't picked up a task yet
+        self._wakeups = 0
+        self._shutdown = False
+
+        # counters
+        self.submitted = 0
+        self.completed = 0
+        self.rejected = 0
+        self.failed = 0
+        self.peak_queue_depth = 0
+
+    @classmethod
+    def from_settings(cls, settings):
+        """Create a pool from the given settings dict, as stored in bot.json."""
+        kwargs = {}
+        for key in default_pool_settings:
+            if key in settings:
+                kwargs[key] = settings[key]
+        return cls(**kwargs)
+
+    @property
+    def queue_depth(self):
+        """Number of tasks waiting to be run."""
+        with self._lock:
+            return self._pending_count()
+
+    def _pending_count(self):
+        return len(self._queue) + sum(len(held) for held in self._held.values())
+
+    def stats(self):
+        """Return a dict of our current counters."""
+        with self._lock:
+            return {
+                'workers': len(self._workers),
+                'active': sum(self._running.values()),
+                'queue_depth': self._pending_count(),
+                'peak_queue_depth': self.peak_queue_depth,
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'failed': self.failed,
+                'rejected': self.rejected,
+            }
+
+    def submit(self, key, fn, *args, block=True):
+        """Queue fn(*args) to be run by the pool, returns False if it was rejected.
+
+        With block=False, we never wait for space, whatever our overflow policy is.
+        """
+        with self._lock:
+            if self._shutdown:
+                self.rejected += 1
+                return False
+
+            if self._pending_count() >= self.max_queue:
+                if self.overflow == OVERFLOW_BLOCK and block:
+                    end_ts = time.time() + self.block_timeout
+                    while self._pending_count() >= self.max_queue and not self._shutdown:
+                        remaining = end_ts - time.time()
+                        if remaining <= 0:
+                            break
+                        self._not_full.wait(remaining)
+
+                if self._pending_count() >= self.max_queue or self._shutdown:
+                    self.rejected += 1
+                    return False
+
+            self._queue.append((key, fn, args))
+            self.submitted += 1
+            self.peak_queue_depth = max(self.peak_queue_depth, self._pending_count())
+
+            # spin up workers lazily, only as we need them
+            if not self._wake_worker() and len(self._workers) < self.max_workers:
+                worker = threading.Thread(target=self._worker,
+                                          name='goshu-worker-{}'.format(len(self._workers)),
+                                          daemon=True)
+                self._workers.append(worker)
+                worker.start()
+
+        return True
+
+    def _wake_worker(self):
+        """Wake an idle worker that isn't already being woken, call with the lock held."""
+        if self._idle_workers <= self._wakeups:
+            return False
+        self._wakeups += 1
+        self._not_empty.notify()
+        return True
+
+    def _next_task(self):
+        """Pop the next task we're allowed to run, call with the lock held."""
+        while True:
+            while not self._queue and not self._shutdown:
+                self._idle_workers += 1
+                self._not_empty.wait()
+                self._idle_workers -= 1
+                if self._wakeups:
+                    self._wakeups -= 1
+
+            if not self._queue:
+                return None
+
+            key, fn, args = self._queue.popleft()
+            self._not_full.notify()
+
+            if self._running[key] >= self.module_limit:
+                self._held.setdefault(key, collections.deque()).append((key, fn, args))
+                continue
+
+            self._running[key] += 1
+            return key, fn, args
+
+    def _worker(self):
+        while True:
+            with self._lock:
+                task = self._next_task()
+            if task is None:
+                return
+
+            key, fn, args = task
+            failed = False
+            try:
+                fn(*args)
+            except BaseException:
+                failed = True
+                traceback.print_exc()
+
+            with self._lock:
+                self.completed += 1
+                if failed:
+                    self.failed += 1
+
+                self._running[key] -= 1
+                if not self._running[key]:
+                    del self._running[key]
+
+                # let a held task with the same key go next
+                held = self._held.get(key)
+                if held:
+                    self._queue.appendleft(held.popleft())
+                    if not held:
+                        del self._held[key]
+                    self._wake_worker()
+
+    def shutdown(self, wait=True, timeout=None):
+        """Stop accepting new tasks and let the workers finish what's queued."""
+        with self._lock:
+            self._shutdown = True
+            self._not_empty.notify_all()
+            self._not_full.notify_all()
+            workers = list(self._workers)
+
+        if wait:
+            end_ts = None if timeout is None else time.time() + timeout
+            for worker in workers:
+                if end_ts is None:
+                    worker.join()
+                else:
+                    worker.join(max(0, end_ts - time.time()))
@@ -2,29 +2,224 @@
 # Goshu IRC Bot
 # written by Daniel Oaks <daniel@danieloaks.net>
 # licensed under the ISC license
+"""Converts Goshu's logfiles into plain text, ANSI-coloured text or structured logs.
 
+Run with -h for usage.
+"""
+
+import argparse
+import concurrent.futures
+import json
+import os
+import re
 import sys
+import time
 
-# XXX - TODO: - Run over entire log dir at once
-# XXX - TODO: - Output ANSI colour codes instead of IRC colour codes
 from girc.formatting import escape, remove_control_codes
 
-if len(sys.argv) < 2:
-    print('USAGE:')
-    print('\t', sys.argv[0], '<logfile>')
-    exit()
+from gbot.jsonlog import JsonLogSink
+from gbot.libs.helper import write_atomically
+from gbot.logwriter import LogWriter
+
+# output format -> extension added to the converted file's name
+output_extensions = {
+    'text': '.txt',
+    'ansi': '.ansi',
+    'jsonl': '.jsonl',
+}
+
+# which files we've converted, so we can skip them next time
+manifest_name = '.converted.json'
+
+# lines are read and written this many characters at a time
+read_size = 4 * 1024 * 1024
+
+timestamp_regex = re.compile(r'^\s*(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d) ')
+nick_regex = re.compile(r'^\S+ \S+ \S+ \S+ <.?([^>\s]+)>')
+
+
+def find_logfiles(paths):
+    """Yield every logfile in the given files and folders."""
+    for path in paths:
+        if os.path.isfile(path):
+            yield path
+            continue
+
+        for folder, subfolders, filenames in os.walk(path):
+            subfolders.sort()
+            for name in sorted(filenames):
+                if name.endswith('.log'):
+                    yield os.path.join(folder, name)
+
+
+def output_path(path, fmt, out_folder=None):
+    """Return where the given logfile's converted version goes.
+
+    With out_folder, the file keeps its path relative to the current folder inside it, so
+    files outside the current folder can't be put there.
+    """
+    new_path = path + output_extensions[fmt]
+    if out_folder:
+        try:
+            rel_path = os.path.normpath(os.path.relpath(new_path))
+        except ValueError:
+            rel_path = None  # on another drive
+        if rel_path is None or rel_path == os.pardir or rel_path.startswith(os.pardir + os.sep):
+            raise Exception('{} is outside the current folder, so it has no place in the '
+                            'output folder'.format(path))
+        new_path = os.path.join(out_folder, rel_path)
+    return new_path
+
+
+def _lines(path):
+    """Yield lists of lines from the given file, reading it in large chunks."""
+    with open(path, 'r', encoding='utf-8', errors='replace', buffering=read_size) as log_file:
+        while True:
+            lines = log_file.readlines(read_size)
+            if not lines:
+                return
+            yield lines
+
+
+def _convert_text(path, new_path, render):
+    with open(new_path, 'w', encoding='utf-8', buffering=read_size) as new_file:
+        for lines in _lines(path):
+            new_file.write(''.join([render(escape(line.rstrip('\n'))) + '\n' for line in lines]))
+
+
+def _convert_jsonl(path, new_path):
+    # start from scratch, rather than adding onto an old conversion
+    for old_path in (new_path, new_path + '.idx'):
+        if os.path.exists(old_path):
+            os.remove(old_path)
+
+    log_writer = LogWriter()
+    sink = JsonLogSink(log_writer)
+
+    try:
+        for lines in _lines(path):
+            for line in lines:
+                line = escape(line.rstrip('\n'))
+                plain_line = remove_control_codes(line)
+
+                # 'Logfile Opened' and 'New Day' markers, which don't mean much here
+                match = timestamp_regex.match(plain_line)
+                if not match:
+                    continue
+                record = {
+                    'ts': time.mktime(time.strptime(match.group(1), '%Y-%m-%d %H:%M:%S')),
+                    'line': line,
+                }
+                match = nick_regex.match(plain_line)
+                if match:
+                    record['nick'] = match.group(1)
+
+                sink.write(new_path, record)
+    finally:
+        sink.close()
+        log_writer.close()
+
+    # logs with nothing in them still get an output file, so we know they're done
+    if not os.path.exists(new_path):
+        open(new_path, 'w').close()
+
+
+def convert_file(path, new_path, fmt):
+    """Convert the given logfile, returns the number of bytes read."""
+    folder = os.path.dirname(new_path)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder, exist_ok=True)
+
+    if fmt == 'text':
+        _convert_text(path, new_path, remove_control_codes)
+    elif fmt == 'ansi':
+        # pulls in gbot.modules and girc, so we don't import it unless we have to
+        from modules.log_display import display_unescape
+        _convert_text(path, new_path, lambda line: display_unescape(line + '$r'))
+    elif fmt == 'jsonl':
+        _convert_jsonl(path, new_path)
+
+    return os.path.getsize(path)
+
+
+def load_manifest(path):
+    try:
+        with open(path, 'r', encoding='utf-8') as manifest_file:
+            return json.loads(manifest_file.read())
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Convert Goshu logfiles into plain text, '
+                                                 'ANSI-coloured text, or structured JSON Lines '
+                                                 'logs with an index.')
+    parser.add_argument('paths', nargs='*', default=['logs'],
+                        help='logfiles or folders of logfiles to convert (default: logs)')
+    parser.add_argument('-f', '--format', choices=sorted(output_extensions), default='text',
+                        help='output format (default: text)')
+    parser.add_argument('-o', '--out', default=None,
+                        help='folder to put converted files in (default: next to the originals)')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='number of files to convert at once (default: number of CPUs)')
+    parser.add_argument('--force', action='store_true',
+                        help="convert files even if they haven't changed since last time")
+    args = parser.parse_args(argv)
+
+    manifest_path = os.path.join(args.out or '.', manifest_name)
+    manifest = load_manifest(manifest_path)
+
+    # work out what needs converting
+    jobs = []
+    skipped = 0
+    for path in find_logfiles(args.paths):
+        try:
+            new_path = output_path(path, args.format, args.out)
+        except Exception as ex:
+            print('skipping', path, '-', ex)
+            continue
+        stat = os.stat(path)
+        key = '{}:{}'.format(args.format, os.path.abspath(path))
+        state = [stat.st_mtime, stat.st_size]
+
+        if not args.force and manifest.get(key) == state and os.path.exists(new_path):
+            skipped += 1
+            continue
+        jobs.append((path, new_path, key, state))
+
+    if not jobs:
+        print('nothing to convert,', skipped, 'files unchanged')
+        return
+
+    start = time.time()
+    total_bytes = 0
+
+    # biggest first, so one large file doesn't hold everything up at the end
+    jobs.sort(key=lambda job: job[3][1], reverse=True)
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        futures = {}
+        for path, new_path, key, state in jobs:
+            future = executor.submit(convert_file, path, new_path, args.format)
+            futures[future] = (path, new_path, key, state)
 
-oldlog = open(sys.argv[1], 'r', encoding='utf8')
-newlog = open(sys.argv[1] + '.new', 'w', encoding='utf8')
+        for future in concurrent.futures.as_completed(futures):
+            path, new_path, key, state = futures[future]
+            try:
+                total_bytes += future.result()
+            except Exception as ex:
+                print('failed to convert', path, '-', ex)
+                continue
 
-line = escape(oldlog.readline())
+            # saved as we go, so an interrupted run doesn't lose what it's done
+            manifest[key] = state
+            write_atomically(manifest_path, json.dumps(manifest, sort_keys=True, indent=4))
+            print(path, '->', new_path)
 
-while line != '':
-    new_line = remove_control_codes(line)
+    elapsed = time.time() - start
+    print('converted {} files ({:.1f} MB) in {:.1f}s, {} unchanged'
+          ''.format(len(jobs), total_bytes / 1024 / 1024, elapsed, skipped))
 
-    newlog.write(new_line)
-    line = escape(oldlog.readline())
-    new_line = ''
 
-oldlog.close()
-newlog.close()
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+# Goshu IRC Bot
+# written by Daniel Oaks <daniel@danieloaks.net>
+# licensed under the ISC license
+
+import os
+import sys
+
+from gbot.info import migrate_to_sqlite
+
+if '-h' in sys.argv[1:] or '--help' in sys.argv[1:]:
+    print('USAGE:')
+    print('\t', sys.argv[0], '[<store.json> ...]')
+    print()
+    print('Copies the given JSON stores, or the accounts and module stores in config/ if none')
+    print('are given, into SQLite stores. Set "store_backend" to "sqlite" in config/bot.json')
+    print('to have Goshu use them.')
+    exit()
+
+paths = sys.argv[1:]
+
+if not paths:
+    # bot.json holds our settings, so it always stays as json
+    for name in ['info.json', 'irc.json']:
+        paths.append(os.path.join('config', name))
+
+    modules_folder = os.path.join('config', 'modules')
+    if os.path.isdir(modules_folder):
+        for name in sorted(os.listdir(modules_folder)):
+            if name.endswith('.json') and name != 'info_dict.json':
+                paths.append(os.path.join(modules_folder, name))
+
+for path in paths:
+    if not os.path.exists(path):
+        continue
+
+    sqlite_path = os.path.splitext(path)[0] + '.sqlite'
+    if os.path.exists(sqlite_path):
+        print('skipping', path, '-', sqlite_path, 'already exists')
+        continue
+
+    migrate_to_sqlite(path, sqlite_path)
+    print('migrated', path, '->', sqlite_path)
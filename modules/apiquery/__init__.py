@@ -7,12 +7,21 @@ import urllib.parse
 
 from girc.formatting import unescape
 
-from gbot.libs.helper import get_url, format_extract
+from gbot.libs.helper import extract_plan, format_extract
 from gbot.modules import Module
 
 
 class apiquery(Module):
 
+    def _json_command_callback(self, new_json, diff=None):
+        Module._json_command_callback(self, new_json, diff)
+
+        # compile response extraction rules now, rather than on the first query
+        updated = new_json if diff is None else diff.updated
+        for info in updated.values():
+            if 'format' in info:
+                extract_plan(info)
+
     def combined(self, event, command, usercommand):
         if usercommand.arguments == '':
             usercommand.arguments = ' '
@@ -23,8 +32,10 @@ class apiquery(Module):
         })
 
         url = command.json['url'].format(**values)
-        r = get_url(url)
+        self.fetch_url(url, self._combined_response, event, command,
+                       cache=True, cache_ttl=command.json.get('cache_ttl'))
 
+    def _combined_response(self, r, event, command):
         if isinstance(r, str):
             display_name = command.json['display_name']
             event['from_to'].msg(unescape('*** {}: {}'.format(display_name, r)))
@@ -5,8 +5,7 @@
 
 import json
 import os
-import socket
-import urllib.request, urllib.parse, urllib.error
+import urllib.parse
 
 from girc.formatting import escape, unescape
 import hashlib
@@ -51,14 +50,14 @@ class danbooru(Module):
             username = None
             password = None
 
-        response += self.retrieve_url(command.json['url'],
-                                      usercommand.arguments,
-                                      command.json['version'],
-                                      username, password)
+        api_url = self.api_url(command.json['url'], usercommand.arguments,
+                               command.json['version'], username, password)
+        self.fetch_url(api_url, self._combined_response, event, response, command.json['url'])
 
-        event['from_to'].msg(response)
+    def _combined_response(self, r, event, response, url):
+        event['from_to'].msg(response + self.describe_results(url, r))
 
-    def retrieve_url(self, url, tags, version, username=None, password=None):
+    def api_url(self, url, tags, version, username=None, password=None):
         post = {
             b'limit': 1,
             b'tags': unescape(tags),
@@ -78,21 +77,14 @@ class danbooru(Module):
             api_position = '/post/index.json?'
         elif version == 2:
             api_position = '/posts.json?'
-        api_url = url + api_position + encoded_tags
+        return url + api_position + encoded_tags
 
-        try:
-            search_results = urllib.request.urlopen(api_url)
-
-        except socket.timeout:
-            return 'Connection timed out'
-
-        except urllib.error.URLError:
-            return 'Connection Error'
-
-        results_http = search_results.read().decode('utf-8')
+    def describe_results(self, url, r):
+        if isinstance(r, str):
+            return r
 
         try:
-            results_json = json.loads(results_http)
+            results_json = json.loads(r.text)
 
         except ValueError:
             return "Not a JSON response"
@@ -5,11 +5,12 @@
 
 import json
 import os
-import socket
-import urllib.request, urllib.parse, urllib.error
+import urllib.parse
 
 from girc.formatting import escape, unescape
+import requests
 
+from gbot.httpclient import http_client
 from gbot.libs.helper import filename_escape
 from gbot.modules import Module
 
@@ -46,31 +47,31 @@ class dictionary(Module):
         response = '*** Wordnik: '
 
         try:
-            url_results = urllib.request.urlopen(url)
-            json_result = json.loads(url_results.read().decode('utf-8'))
-            response += escape(json_result[0]['word'])
-            if 'partOfSpeech' in json_result[0]:
-                response += ' ('
-                response += escape(json_result[0]['partOfSpeech'])
-                response += ')'
-            response += ' --- '
-            response += escape(json_result[0]['text'])
-
-        except urllib.error.URLError:
-            response += 'You broke it, nice job'
-
-        except socket.timeout:
-            response = 'Connection timed out'
-
-        except urllib.error.HTTPError as error_code:
-            if '404' in error_code:
+            r = http_client().get(url)
+            if r.status_code == 404:
                 response += 'No Search Terms'
 
-            elif '401' in error_code:
+            elif r.status_code == 401:
                 response += 'API Key Auth Fail'
 
+            elif not r.ok:
+                response += 'HTTP Error {}'.format(r.status_code)
+
             else:
-                response += str(error_code)
+                json_result = json.loads(r.text)
+                response += escape(json_result[0]['word'])
+                if 'partOfSpeech' in json_result[0]:
+                    response += ' ('
+                    response += escape(json_result[0]['partOfSpeech'])
+                    response += ')'
+                response += ' --- '
+                response += escape(json_result[0]['text'])
+
+        except requests.exceptions.Timeout:
+            response = 'Connection timed out'
+
+        except requests.exceptions.RequestException:
+            response += 'You broke it, nice job'
 
         except IndexError:
             response += 'Definition Not Found'
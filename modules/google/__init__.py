@@ -4,8 +4,7 @@
 # licensed under the ISC license
 
 import json
-import socket
-import urllib.request, urllib.parse, urllib.error
+import urllib.parse
 
 from girc.formatting import escape, unescape
 
@@ -22,10 +21,8 @@ class google(Module):
         @alias g
         @usage <query>
         """
-        result = self.google_result_search(usercommand.arguments)
-        response = '*** $c12G$c4o$c8o$c12g$c3l$c4e$c: {}'.format(result)
-
-        event['from_to'].msg(response)
+        self.fetch_url(self.search_url(usercommand.arguments), self._search_response, event,
+                       '*** $c12G$c4o$c8o$c12g$c3l$c4e$c: ', cache=True)
 
     def combined(self, event, command, usercommand):
         query = ''
@@ -37,30 +34,28 @@ class google(Module):
             name = command.json['display_name']
         else:
             name = usercommand.command
-        response = '*** ' + name + ': '
-        response += self.google_result_search(query)
+        self.fetch_url(self.search_url(query), self._search_response, event,
+                       '*** ' + name + ': ', cache=True, cache_ttl=command.json.get('cache_ttl'))
 
-        event['from_to'].msg(response)
+    def _search_response(self, r, event, prefix):
+        event['from_to'].msg(prefix + self.describe_result(r))
 
-    def google_result_search(self, query):
+    def search_url(self, query):
         url = 'https://ajax.googleapis.com/ajax/services/search/web?v=1.0&'
         url += urllib.parse.urlencode({b'q': unescape(query)})
+        return url
 
-        try:
-            search_results = urllib.request.urlopen(url)
-            try:
-                json_result = json.loads(search_results.read().decode('utf-8'))
-                html_result = json_result['responseData']['results'][0]['titleNoFormatting']
-                url_result = escape(html_unescape(html_result))
-                url_result += ' -- '
-                url_result += escape(json_result['responseData']['results'][0]['unescapedUrl'])
-            except:
-                url_result = 'No Results'
-
-        except urllib.error.URLError:
-            url_result = 'Connection Error'
+    def describe_result(self, r):
+        if isinstance(r, str):
+            return r
 
-        except socket.timeout:
-            url_result = 'Connection timed out'
+        try:
+            json_result = json.loads(r.text)
+            html_result = json_result['responseData']['results'][0]['titleNoFormatting']
+            url_result = escape(html_unescape(html_result))
+            url_result += ' -- '
+            url_result += escape(json_result['responseData']['results'][0]['unescapedUrl'])
+        except:
+            url_result = 'No Results'
 
         return url_result
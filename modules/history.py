@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+# Goshu IRC Bot
+# written by Daniel Oaks <daniel@danieloaks.net>
+# licensed under the ISC license
+
+import collections
+import os
+import sqlite3
+import threading
+import time
+import traceback
+
+from girc.formatting import escape, remove_control_codes
+
+from gbot.libs.helper import filename_escape, time_metric
+from gbot.modules import Module
+from modules.log_display import hide_pw_if_necessary
+
+CREATE_TABLES_SQL = '''
+CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY, ts REAL NOT NULL,
+    server TEXT NOT NULL, target TEXT NOT NULL, nick TEXT NOT NULL, kind TEXT NOT NULL,
+    message TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS messages_target ON messages (server, target COLLATE NOCASE, ts);
+CREATE INDEX IF NOT EXISTS messages_nick ON messages (server, nick COLLATE NOCASE, ts);
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(message, content='messages',
+    content_rowid='id');
+'''
+
+
+def fts_query(text):
+    """Turn user input into an FTS query that matches all the given words."""
+    words = []
+    for word in text.split():
+        words.append('"{}"'.format(word.replace('"', '""')))
+    return ' '.join(words)
+
+
+class HistoryIndex:
+    """Full-text index of messages, stored in SQLite.
+
+    Messages are queued up and written in batches on a background thread, every
+    `flush_interval` seconds or once `batch_size` messages are waiting. Target and nick
+    names are matched case-insensitively.
+    """
+
+    def __init__(self, path, batch_size=500, flush_interval=2, max_queue=50000):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript(CREATE_TABLES_SQL)
+        self._db_lock = threading.Lock()
+
+        self._pending = collections.deque()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._closed = False
+
+        # counters
+        self.indexed = 0
+        self.dropped = 0
+
+    def add(self, server, target, nick, kind, message, ts=None):
+        """Queue the given message to be indexed."""
+        if ts is None:
+            ts = time.time()
+
+        with self._lock:
+            if self._closed or len(self._pending) >= self.max_queue:
+                self.dropped += 1
+                return
+
+            self._pending.append((ts, server, target, nick, kind, message))
+
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._indexer, name='goshu-history',
+                                                daemon=True)
+                self._thread.start()
+
+            if len(self._pending) >= self.batch_size:
+                self._wakeup.set()
+
+    def _indexer(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+
+            try:
+                self.flush()
+            except Exception:
+                traceback.print_exc()
+
+            if self._closed:
+                return
+
+    def flush(self):
+        """Index everything that's waiting, a batch at a time."""
+        while True:
+            with self._lock:
+                batch = []
+                while self._pending and len(batch) < self.batch_size:
+                    batch.append(self._pending.popleft())
+            if not batch:
+                return
+
+            with self._db_lock, self._db:
+                last_id = self._db.execute('SELECT IFNULL(MAX(id), 0) FROM messages').fetchone()[0]
+                self._db.executemany('INSERT INTO messages (ts, server, target, nick, kind, '
+                                     'message) VALUES (?, ?, ?, ?, ?, ?)', batch)
+                self._db.execute('INSERT INTO messages_fts (rowid, message) '
+                                 'SELECT id, message FROM messages WHERE id > ?', (last_id, ))
+            self.indexed += len(batch)
+
+    def _query(self, sql, args):
+        with self._db_lock:
+            cursor = self._db.execute(sql, args)
+            columns = [column[0] for column in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def search(self, server, text, target=None, nick=None, since=None, limit=5):
+        """Return the newest messages containing all the words in text, newest first."""
+        query = fts_query(text)
+        if not query:
+            return []
+
+        sql = ('SELECT messages.* FROM messages_fts JOIN messages '
+               'ON messages.id = messages_fts.rowid '
+               'WHERE messages_fts MATCH ? AND messages.server = ?')
+        args = [query, server]
+
+        if target is not None:
+            sql += ' AND messages.target = ? COLLATE NOCASE'
+            args.append(target)
+        if nick is not None:
+            sql += ' AND messages.nick = ? COLLATE NOCASE'
+            args.append(nick)
+        if since is not None:
+            sql += ' AND messages.ts >= ?'
+            args.append(since)
+
+        sql += ' ORDER BY messages.id DESC LIMIT ?'
+        args.append(limit)
+
+        return self._query(sql, args)
+
+    def last_message(self, server, nick, target=None):
+        """Return the last message we saw from nick, optionally only in target, or None."""
+        sql = 'SELECT * FROM messages WHERE server = ? AND nick = ? COLLATE NOCASE'
+        args = [server, nick]
+
+        if target is not None:
+            sql += ' AND target = ? COLLATE NOCASE'
+            args.append(target)
+
+        sql += ' ORDER BY ts DESC LIMIT 1'
+
+        rows = self._query(sql, args)
+        return rows[0] if rows else None
+
+    def close(self):
+        """Index everything that's waiting, and close our database."""
+        with self._lock:
+            self._closed = True
+            thread = self._thread
+        self._wakeup.set()
+        if thread is not None:
+            thread.join()
+
+        self.flush()
+        with self._db_lock:
+            self._db.close()
+
+
+def is_private(server, row):
+    """Return True if the given row was said to us privately, rather than in a channel."""
+    return not row['target'] or not server.is_channel(row['target'])
+
+
+def describe_message(row, show_target=True):
+    ago = time_metric(secs=int(time.time() - row['ts'])) or '0s'
+    output = '$b{}$b '.format(escape(row['nick']))
+    if show_target:
+        output += 'in $b{}$b '.format(escape(row['target']))
+    output += '{} ago: '.format(ago)
+
+    if row['kind'] == 'action':
+        output += '* {} '.format(escape(row['nick']))
+    output += escape(row['message'])
+    return output
+
+
+class history(Module):
+    """Keeps a searchable history of what's been said."""
+
+    def __init__(self, bot):
+        Module.__init__(self, bot)
+
+        db_file = '{}{}sqlite'.format(filename_escape(self.name), os.extsep)
+        self.index = HistoryIndex(os.path.join('config', 'modules', db_file))
+
+    def unload(self):
+        self.index.close()
+
+    def history_listener(self, event):
+        """Indexes messages as they come in
+
+        @listen in pubmsg inline
+        @listen in privmsg inline
+        @listen in action inline
+        """
+        if event['verb'] == 'pubmsg':
+            target = event['target'].name
+        else:
+            target = event['from_to'].name
+
+        message = remove_control_codes(escape(event['message']))
+        message = hide_pw_if_necessary(message, self.bot.settings.store['command_prefix'])
+
+        self.index.add(event['server'].name, target, event['source'].nick, event['verb'], message)
+
+    # python api
+    def search(self, server_name, text, target=None, nick=None, since=None, limit=5):
+        """Search what's been said on the given server, see HistoryIndex.search."""
+        return self.index.search(server_name, text, target=target, nick=nick, since=since,
+                                 limit=limit)
+
+    def seen(self, server_name, nick, target=None):
+        """Return the last thing nick said, optionally only in target, or None."""
+        return self.index.last_message(server_name, nick, target)
+
+    # commands
+    def cmd_search(self, event, command, usercommand):
+        """Search what's been said here
+
+        @usage [--nick <nick>] <words>
+        """
+        nick = None
+        text = usercommand.arguments
+        if text.startswith('--nick '):
+            nick, text = usercommand.arg_split(2)[1:]
+
+        if not text.strip():
+            event['source'].msg('Usage: search [--nick <nick>] <words>')
+            return
+
+        # private conversations aren't searchable, even by whoever has that nick now
+        if not event['from_to'].is_channel:
+            event['source'].msg('*** History: Search only works in channels')
+            return
+
+        results = self.search(event['server'].name, text, target=event['from_to'].name,
+                              nick=nick, limit=3)
+        if not results:
+            event['from_to'].msg('*** History: Nothing found')
+            return
+
+        for row in results:
+            event['from_to'].msg('*** History: ' + describe_message(row, show_target=False))
+
+    def cmd_seen(self, event, command, usercommand):
+        """Show the last thing someone said, anywhere we've seen them
+
+        @usage <nick>
+        """
+        nick = usercommand.arguments.strip()
+        if not nick:
+            return
+
+        row = self.seen(event['server'].name, nick)
+        if row is None:
+            event['from_to'].msg("*** Seen: I haven't seen {}".format(escape(nick)))
+            return
+
+        # don't give away what's been said in private, messages or actions
+        if is_private(event['server'], row):
+            row['kind'] = 'privmsg'
+            row['message'] = '(private message)'
+            row['target'] = 'private'
+
+        event['from_to'].msg('*** Seen: ' + describe_message(row))
+
+    def cmd_lastseen(self, event, command, usercommand):
+        """Show the last thing someone said in this channel
+
+        @usage <nick>
+        """
+        nick = usercommand.arguments.strip()
+        if not nick:
+            return
+
+        # private conversations stay private, even from whoever has that nick now
+        if not event['from_to'].is_channel:
+            event['source'].msg('*** Last Seen: This only works in channels')
+            return
+
+        row = self.seen(event['server'].name, nick, target=event['from_to'].name)
+        if row is None:
+            event['from_to'].msg("*** Last Seen: I haven't seen {} here".format(escape(nick)))
+            return
+
+        event['from_to'].msg('*** Last Seen: ' + describe_message(row, show_target=False))
@@ -36,15 +36,12 @@ class invite(Module):
         server_name = event['server'].name
         channel_name = unescape(event['target'].name.lower())
 
-        if 'autojoin_channels' not in self.bot.info.store['servers'].get(server_name, {}):
-            self.bot.info.store['servers'][server_name]['autojoin_channels'] = []
+        key = ['servers', server_name, 'autojoin_channels']
 
-        if (channel_name not in
-                self.bot.info.store['servers'][server_name]['autojoin_channels']):
-            server_dict = self.bot.info.store['servers'][server_name]
-            server_dict['autojoin_channels'].append(channel_name)
-            self.bot.info.store['servers'][server_name] = server_dict
-            self.bot.info.save()
+        with self.bot.info.batch():
+            self.bot.info.initialize_to(key, [])
+            if channel_name not in self.bot.info.get(key):
+                self.bot.info.append_to(key, channel_name)
 
         event['from_to'].msg("I'll now autojoin this channel! The command to remove me is:  "
                              "{p}remchan".format(p=self.bot.settings.store['command_prefix']))
@@ -63,17 +60,11 @@ class invite(Module):
         server_name = event['server'].name
         channel_name = event['target'].name.lower()
 
-        if 'autojoin_channels' not in self.bot.info.store['servers'].get(server_name, {}):
-            server_dict = self.bot.info.store['servers'].get(server_name, {})
-            server_dict['autojoin_channels'] = []
-            self.bot.info.store['servers'][server_name] = server_dict
-
-        if (channel_name in
-                self.bot.info.store['servers'].get(server_name, {})['autojoin_channels']):
-            server_dict = self.bot.info.store['servers'].get(server_name, {})
-            server_dict['autojoin_channels'].remove(channel_name)
-            self.bot.info.store['servers'][server_name] = server_dict
-            self.bot.info.save()
+        key = ['servers', server_name, 'autojoin_channels']
+
+        with self.bot.info.batch():
+            if channel_name in self.bot.info.get(key, []):
+                self.bot.info.remove_from(key, channel_name)
 
         event['from_to'].msg("I won't autojoin this channel after I'm kicked or shutdown. "
                              "The command to readd me is:  "
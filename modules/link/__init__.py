@@ -8,33 +8,98 @@
 # In particular, the regexes and the display layout. Thanks a bunch, bro!
 
 import re
-import time
 
 from girc.formatting import escape, unescape
-from girc.utils import CaseInsensitiveDict
 
-from gbot.libs.helper import get_url, format_extract, JsonHandler
+from gbot.libs.helper import extract_plan, format_extract, JsonHandler
 from gbot.modules import Module
+from gbot.ratelimit import RateLimiter
+
+url_regex = re.compile('(?:https?://)(\\S+)')
+
+# can be changed with the 'link' key in bot.json
+default_link_settings = {
+    # most links we'll look up from a single message
+    'max_links': 3,
+    # seconds we'll wait for all of a message's links to be looked up
+    'deadline': 10,
+    # most bytes we'll download for a single lookup, can be changed for each provider with
+    #   its 'max_bytes' value
+    'max_bytes': 1024 * 1024,
+}
+
+# named groups and anything else we can't put into a combined matcher regex
+named_group_regex = re.compile(r'(?<!\\)\(\?P<[^>]+>')
+unsafe_pattern_regex = re.compile(r'\(\?P=|\\[1-9]|^\(\?[aiLmsux]+\)')
+
+
+class LinkMatcher:
+    """Matches URLs against all our link providers at once.
+
+    Provider patterns are joined into one regex (with their named groups removed) that
+    tells us the first provider that matches, so URLs that don't match anything only cost
+    a single regex match. Patterns that can't be joined like that are checked separately.
+    """
+
+    def __init__(self, links):
+        # (provider, info, compiled pattern, whether it's in the combined regex)
+        self.providers = []
+
+        combined = []
+        for provider, info in links.items():
+            pattern = info['match']
+            compiled = re.compile(pattern)
+
+            stripped = named_group_regex.sub('(?:', pattern)
+            in_combined = not unsafe_pattern_regex.search(stripped)
+            if in_combined:
+                combined.append('(?P<p{}>{})'.format(len(self.providers), stripped))
+
+            self.providers.append((provider, info, compiled, in_combined))
+
+        self.separate = [i for i, p in enumerate(self.providers) if not p[3]]
+        self.combined = re.compile('|'.join(combined)) if combined else None
+
+    def _candidates(self, url):
+        if self.combined is not None:
+            match = self.combined.match(url)
+            if match:
+                first = int(match.lastgroup[1:])
+                return [i for i, p in enumerate(self.providers) if i >= first or not p[3]]
+        return self.separate
+
+    def matches(self, url):
+        """Yield (provider, info, match) for every provider matching the url, in order."""
+        for i in self._candidates(url):
+            provider, info, compiled, in_combined = self.providers[i]
+            match = compiled.match(url)
+            if match:
+                yield provider, info, match
+
+    def any_match(self, url):
+        """Whether any provider matches the given url."""
+        for provider, info, match in self.matches(url):
+            return True
+        return False
 
 
-class Cooldown:
-    def __init__(self, cooldown_seconds=15, multiple=2, max_cooldown=60*60*24):
-        self.cooldown_seconds = cooldown_seconds
-        self.end_ts = time.time()
-        self.default_multiple = multiple
-        self.multiple = multiple
-        self.max_cooldown = max_cooldown
+def rate_limit_policy(cooldown):
+    """Return (RateLimiter settings, match groups to limit on) from a provider's cooldown.
 
-    def can_do(self):
-        if time.time() > self.end_ts:
-            self.multiple = self.default_multiple
-            self.end_ts = time.time() + self.cooldown_seconds
-            return True
+    cooldown can be the name of a match group (or a list of them) to rate limit each value
+    separately, for example each video ID, or a dict with a 'key' group name or list, plus
+    any RateLimiter settings. Without one, each channel or user is limited as a whole.
+    """
+    if isinstance(cooldown, dict):
+        settings = dict(cooldown)
+        groups = settings.pop('key', [])
+    else:
+        settings = {}
+        groups = cooldown or []
 
-        self.multiple *= self.default_multiple
-        cooldown = min(self.cooldown_seconds * self.multiple, self.max_cooldown)
-        self.end_ts = time.time() + cooldown
-        return False
+    if isinstance(groups, str):
+        groups = [groups]
+    return settings, list(groups)
 
 
 class link(Module):
@@ -43,13 +108,32 @@ class link(Module):
     def __init__(self, bot):
         Module.__init__(self, bot)
         self.links = []
-        self.cooldowns = {}
+        self.link_matcher = LinkMatcher({})
+        # provider -> (RateLimiter, match groups it limits on), or None if it's unlimited
+        self.rate_limits = {}
         self.json_handlers.append(JsonHandler(self, self.dynamic_path,
                                               attr='links', ext='lnk', yaml=True,
                                               callback_name='_link_json_callback'))
 
-    def _link_json_callback(self, new_json):
-        for key, info in new_json.items():
+    def _link_json_callback(self, new_json, diff=None):
+        self.link_matcher = LinkMatcher(new_json)
+        updated = new_json if diff is None else diff.updated
+
+        # unchanged providers keep their rate limits
+        rate_limits = {}
+        for provider, info in new_json.items():
+            if provider in self.rate_limits and provider not in updated:
+                rate_limits[provider] = self.rate_limits[provider]
+            elif info.get('cooldown') is False:
+                rate_limits[provider] = None
+            else:
+                settings, groups = rate_limit_policy(info.get('cooldown'))
+                rate_limits[provider] = (RateLimiter.from_settings(settings), groups)
+        self.rate_limits = rate_limits
+
+        for key, info in updated.items():
+            extract_plan(info)
+
             for var_name, var_info in info.get('required_values', {}).items():
                 base_name = info['name'][0]
                 self.parse_required_value(base_name, var_name, var_info)
@@ -63,63 +147,83 @@ class link(Module):
         if event['source'].is_me or self.is_ignored(event['from_to']):
             return
 
-        url_matches = re.search('(?:https?://)(\\S+)', unescape(event['message']))
-        if not url_matches:
+        settings = dict(default_link_settings)
+        settings.update(self.bot.settings.get('link', {}))
+
+        # work out every lookup we need to do, in the order the links appear
+        lookups = []
+        seen_urls = set()
+        for url in url_regex.findall(unescape(event['message'])):
+            if url in seen_urls or len(lookups) >= settings['max_links']:
+                continue
+            seen_urls.add(url)
+
+            for provider, info, matches in self.link_matcher.matches(url):
+                if len(lookups) >= settings['max_links']:
+                    break
+                if not self._can_look_up(event, provider, matches):
+                    continue
+
+                complete_dict = {}
+                complete_dict.update(self.get_required_values(provider))
+                for key, value in matches.groupdict().items():
+                    complete_dict[key] = escape(value)
+
+                api_url = info['url'].format(**complete_dict)
+                lookups.append((api_url, info))
+
+        if not lookups:
+            return
+
+        # fetch them all at once, and reply once they're all done
+        requests = []
+        for api_url, info in lookups:
+            requests.append((api_url, {
+                'cache': True,
+                'cache_ttl': info.get('cache_ttl'),
+                'max_bytes': info.get('max_bytes', settings['max_bytes']),
+                'content_types': info.get('content_types'),
+                'stop_at': extract_plan(info).stream_until,
+            }))
+        self.fetch_urls(requests, self._link_responses, event,
+                        [info for api_url, info in lookups], timeout=settings['deadline'])
+
+    def _can_look_up(self, event, provider, matches):
+        """Check and update the given provider's rate limit for the event's target."""
+        rate_limit = self.rate_limits.get(provider)
+        if rate_limit is None:
+            return True
+        limiter, groups = rate_limit
+
+        if event['from_to'].is_user:
+            from_to = event['from_to'].host
+        else:
+            from_to = event['from_to'].name
+
+        key = [event['server'].name.lower(), str(from_to).lower()]
+        for group in groups:
+            key.append(matches.groupdict().get(group))
+        return limiter.allow(tuple(key))
+
+    def _link_responses(self, responses, event, infos):
+        for r, info in zip(responses, infos):
+            self._link_response(r, event, info)
+
+    def _link_response(self, r, event, info):
+        display_name = info['display_name']
+
+        if isinstance(r, str):
+            event['from_to'].msg('*** {}: {}'.format(display_name, r))
             return
 
-        for url in url_matches.groups():
-            response = ''
-            for provider in self.links:
-                if provider not in self.cooldowns:
-                    self.cooldowns[provider] = CaseInsensitiveDict()
-                matches = re.match(self.links[provider]['match'], url)
-                if matches:
-                    # response = '*** {}: '.format(self.links[provider]['display_name'])
-                    response = ''
-
-                    complete_dict = {}
-                    complete_dict.update(self.get_required_values(provider))
-                    for key, value in matches.groupdict().items():
-                        complete_dict[key] = escape(value)
-
-                    # check cooldown
-                    server_name = event['server'].name
-                    if event['from_to'].is_user:
-                        from_to = event['from_to'].host
-                    else:
-                        from_to = event['from_to'].name
-
-                    if server_name not in self.cooldowns[provider]:
-                        self.cooldowns[provider][server_name] = event['server'].idict()
-                    if from_to not in self.cooldowns[provider][server_name]:
-                        self.cooldowns[provider][server_name][from_to] = Cooldown()
-                    if not self.cooldowns[provider][server_name][from_to].can_do():
-                        continue
-
-                    # getting the actual file itself
-                    api_url = self.links[provider]['url'].format(**complete_dict)
-                    r = get_url(api_url)
-
-                    display_name = self.links[provider]['display_name']
-
-                    if isinstance(r, str):
-                        event['from_to'].msg('*** {}: {}'.format(display_name, r))
-                        return
-
-                    # parsing
-                    response += format_extract(self.links[provider], r.text,
-                                               debug=True,
-                                               fail='*** {}: Failed'.format(display_name))
-
-            # remove urls from our response
-            url_matches = re.search('(?:https?://)(\\S+)', response)
-            if url_matches:
-                for url in url_matches.groups():
-                    for provider in self.links:
-                        matches = re.match(self.links[provider]['match'], url)
-                        if matches:
-                            response = response.replace(url, '[REDACTED]')
-
-            if response:
-                event['from_to'].msg(response)
-            return  # don't spam us tryna return every title
+        # parsing
+        response = format_extract(info, r.text, debug=True,
+                                  fail='*** {}: Failed'.format(display_name))
+
+        # remove urls from our response
+        for url in url_regex.findall(response):
+            if self.link_matcher.any_match(url):
+                response = response.replace(url, '[REDACTED]')
+
+        if response:
+            event['from_to'].msg(response)
@@ -5,17 +5,94 @@
 
 from time import strftime, localtime
 import datetime
-import os
 import random
+import re
+import time
 
 from girc.formatting import escape, unescape, colour_name_to_code
 import colorama
 
 from gbot.libs.helper import filename_escape
+from gbot.jsonlog import JsonLogSink
+from gbot.logwriter import LogQueue, LogRotator, LogWriter
 from gbot.modules import Module
 
 colorama.init()
 
+# event values that are live girc objects, and get frozen before the event is queued
+snapshot_keys = ('server', 'source', 'target', 'from_to', 'channel')
+
+
+class TargetInfo:
+    """What we show of a server, user or channel, as it was when the event came in."""
+
+    def __init__(self, target):
+        self.is_user = getattr(target, 'is_user', False)
+        self.is_channel = getattr(target, 'is_channel', False)
+        self.is_server = getattr(target, 'is_server', False)
+
+        name = getattr(target, 'name', None)
+        self.name = str(name) if name is not None else None
+        nick = getattr(target, 'nick', None)
+        self.nick = str(nick) if nick is not None else None
+        self.userhost = str(target.userhost) if self.is_user else None
+
+    def __str__(self):
+        return str(self.name)
+
+
+def user_prefix(channel, nick):
+    """Return the highest prefix (eg '@') the given nick has in channel, or ''."""
+    try:
+        prefixes = channel.prefixes.get(nick)
+    except AttributeError:
+        return ''
+    return prefixes[0] if prefixes else ''
+
+
+def count_user_modes(prefixes):
+    """Return how many (ops, halfops, voices, normals) are in the given prefixes dict."""
+    op_users = 0
+    halfop_users = 0
+    voiced_users = 0
+    normal_users = 0
+
+    for user_prefixes in prefixes.values():
+        user_prefixes = user_prefixes or ''
+        # XXX - TODO: - fix to work with isupport
+        if '$' in user_prefixes or '!' in user_prefixes or '&' in user_prefixes or '~' in user_prefixes:
+            op_users += 1
+        elif '%' in user_prefixes:
+            halfop_users += 1
+        elif '+' in user_prefixes:
+            voiced_users += 1
+        else:
+            normal_users += 1
+
+    return op_users, halfop_users, voiced_users, normal_users
+
+
+def snapshot_event(event):
+    """Copy the event, taking what we show from girc's live objects now.
+
+    By the time we get to displaying it, users may have left or changed nick, so the
+    consumer thread only looks at the plain data in here.
+    """
+    event = dict(event)
+
+    if event['verb'] in ('pubmsg', 'pubnotice'):
+        event['source_prefix'] = user_prefix(event['target'], event['source'].nick)
+    elif event['verb'] == 'endofnames':
+        event['user_modes'] = count_user_modes(event['channel'].prefixes)
+
+    for key in snapshot_keys:
+        if event.get(key) is not None and not isinstance(event[key], str):
+            event[key] = TargetInfo(event[key])
+    if event.get('channels'):
+        event['channels'] = [TargetInfo(chan) for chan in event['channels']]
+
+    return event
+
 
 class log_display(Module):
     """Prints and shows IRC activity, with nice colours!"""
@@ -27,18 +104,63 @@ class log_display(Module):
         self.logfiles_open = {}
         random.seed()
 
+        settings = getattr(self.bot, 'settings', None)
+        if settings is None:
+            settings = {}
+        rotation_settings = settings.get('log_rotation', {})
+        if rotation_settings:
+            rotator = LogRotator.from_settings(rotation_settings)
+        else:
+            rotator = None
+        self.log_writer = LogWriter.from_settings(settings.get('log_writer', {}), rotator=rotator)
+
+        # optional structured logs, see gbot.jsonlog
+        structured_settings = settings.get('structured_logs', {})
+        if structured_settings.get('enabled', False):
+            self.structured_log = JsonLogSink(self.log_writer,
+                                              block_records=structured_settings.get('block_records'))
+        else:
+            self.structured_log = None
+
+        # events are formatted, shown and logged on the queue's thread
+        self.log_queue = LogQueue.from_settings(self.display_event, settings.get('log_queue', {}))
+        self._dropped_reported = 0
+
+        # today's date, and the timestamp when it stops being today
+        self._today = None
+        self._tomorrow_ts = 0
+
         # XXX - debug
-        with open('log.txt', 'a', encoding='utf-8') as log:
-            log.write('\n\n\n')
+        self.log_writer.write('log.txt', '\n\n')
+
+    def unload(self):
+        self.log_queue.close(timeout=5)
+        if self.structured_log:
+            self.structured_log.close()
+        self.log_writer.close()
 
     def log_display_listener(self, event):
-        """Writes messages to screen and log
+        """Queues messages to be written to screen and log
 
         @listen both all highest inline
         @listen both raw highest inline
         """
+        # copy, so later listeners or changes to users and channels don't change what we show
+        self.log_queue.put((time.time(), snapshot_event(event)))
+
+    def display_event(self, record):
+        """Writes the given queued event to screen and log."""
+        ts, event = record
+        now = localtime(ts)
+
+        if self.log_queue.dropped > self._dropped_reported:
+            dropped = self.log_queue.dropped - self._dropped_reported
+            self._dropped_reported += dropped
+            self.bot.gui.put_line(display_unescape('$c4$b** {} line{} dropped from the log queue'
+                                                   '$r'.format(dropped, 's' if dropped > 1 else '')))
+
         if event['verb'] == 'raw':
-            output = strftime('%Y-%m-%d %H:%M:%S - ', localtime())
+            output = strftime('%Y-%m-%d %H:%M:%S - ', now)
             output += event['server'].name
             if event['direction'] == 'in':
                 output += '  -> '
@@ -46,9 +168,7 @@ class log_display(Module):
                 output += ' <-  '
             output += event['data']
             print(output)
-            with open('log.txt', 'a', encoding='utf-8') as log:
-                log.write(output)
-                log.write('\n')
+            self.log_writer.write('log.txt', output)
             return
 
         # drop unnecessary messages
@@ -57,8 +177,8 @@ class log_display(Module):
 
         # > 15:26:43
         output = '$c14'
-        ts = event.get('server_time', localtime())
-        output += strftime('%Y-%m-%d %H:%M:%S ', ts)
+        display_time = event.get('server_time', now)
+        output += strftime('%Y-%m-%d %H:%M:%S ', display_time)
 
         # > -rizon-
         output += '$c12-$c'
@@ -127,17 +247,9 @@ class log_display(Module):
             output += '$c3- '
             output += '$c14<$c'
 
-            selected_mode = ''
-            user_nick = event['source'].nick
-
-            try:
-                if len(event['target'].prefixes[user_nick]):
-                    selected_mode = event['target'].prefixes[user_nick][0]
-                    output += escape(selected_mode)
-                else:
-                    output += ' '
-            except:
-                print('prefixes failed:', user_nick, event['target'].prefixes)
+            if event['source_prefix']:
+                output += escape(event['source_prefix'])
+            else:
                 output += ' '
 
             output += self.nick_color(event['source'].nick)
@@ -152,12 +264,8 @@ class log_display(Module):
             output += '$c3- '
             output += '$c[green]Notice$c -> '
 
-            selected_mode = ''
-            user_nick = event['source'].nick
-
-            if len(event['target'].prefixes[user_nick]):
-                selected_mode = event['target'].prefixes[user_nick][0]
-                output += escape(selected_mode)
+            if event['source_prefix']:
+                output += escape(event['source_prefix'])
             else:
                 output += ' '
 
@@ -294,31 +402,16 @@ class log_display(Module):
 
         elif event['verb'] in ['endofnames', ]:
             chan = escape(event['channel'].name)
-            user_dict = event['channel'].prefixes
+            op_users, halfop_users, voiced_users, normal_users = event['user_modes']
+            user_count = op_users + halfop_users + voiced_users + normal_users
 
             targets.append(chan)
             output += '$c6-$c!$c6-$c '
             output += 'stats:'
             output += '$c10' + chan + '$c: '
-            output += '{} nick{} '.format(len(user_dict), 's' if len(user_dict) > 1 else '')
+            output += '{} nick{} '.format(user_count, 's' if user_count > 1 else '')
             output += '$c3($c'
 
-            normal_users = 0
-            voiced_users = 0
-            halfop_users = 0
-            op_users = 0
-
-            for user in user_dict:
-                # XXX - TODO: - fix to work with isupport
-                if '$' in user_dict[user] or '!' in user_dict[user] or '&' in user_dict[user] or '~' in user_dict[user]:
-                    op_users += 1
-                elif '%' in user_dict[user]:
-                    halfop_users += 1
-                elif '+' in user_dict[user]:
-                    voiced_users += 1
-                else:
-                    normal_users += 1
-
             priv_lists = []
 
             if op_users:
@@ -440,30 +533,52 @@ class log_display(Module):
         # self.bot.gui.put_line(escape(str(debugmsg)))
 
         self.bot.gui.put_line(display_unescape(output + '$r'))  # +$r because that means reset
-        self.log(output, event['server'].name, targets)
-
-    def log(self, output, server='global', targets=['global']):
+        self.log(output, event['server'].name, targets, record={
+            'ts': ts,
+            'verb': event['verb'],
+            'nick': getattr(event.get('source'), 'nick', None),
+        })
+
+    def today(self):
+        """Return today's date, only working it out again once the day changes."""
+        now = time.time()
+        if now >= self._tomorrow_ts:
+            self._today = strftime('%A %B %d', localtime(now))
+            tomorrow = datetime.date.fromtimestamp(now) + datetime.timedelta(days=1)
+            self._tomorrow_ts = time.mktime(tomorrow.timetuple())
+        return self._today
+
+    def log(self, output, server='global', targets=['global'], record=None):
         server_escape = filename_escape(server)
-        targets_escape = []
+        today = self.today()
+        line = None
+
+        if self.structured_log:
+            if record is None:
+                record = {'ts': time.time()}
+            record['line'] = output
+
         for target in targets:
-            targets_escape.append(filename_escape(target))
-        for target in targets_escape:
-            if not os.path.exists('logs'):
-                os.makedirs('logs')
-            if not os.path.exists('logs/{}'.format(server)):
-                os.makedirs('logs/{}'.format(server))
-            path = 'logs/{}.{}.log'.format(server_escape, target)
-
-            if target not in self.logfiles_open or not os.path.exists(path):
-                output = '$c14 Logfile Opened - ' + strftime('%A %B %d, %H:%M:%S %Y', localtime()) + '\n' + output
-                self.logfiles_open[target] = strftime('%A %B %d', localtime())
-            elif self.logfiles_open[target] != strftime('%A %B %d', localtime()):
-                output = '$c14 New Day - ' + strftime('%A %B %d, %H:%M:%S %Y', localtime()) + '\n' + output
-                self.logfiles_open[target] = strftime('%A %B %d', localtime())
-
-            outfile = open(path.lower(), 'a', encoding='utf-8')
-            outfile.write(unescape(output) + '\n')
-            outfile.close()
+            path = 'logs/{}.{}.log'.format(server_escape, filename_escape(target)).lower()
+
+            if self.structured_log:
+                self.structured_log.write(path[:-len('.log')] + '.jsonl', record)
+
+            if path not in self.logfiles_open:
+                header = '$c14 Logfile Opened - '
+            elif self.logfiles_open[path] != today:
+                header = '$c14 New Day - '
+            else:
+                header = None
+
+            if header:
+                self.logfiles_open[path] = today
+                header += strftime('%A %B %d, %H:%M:%S %Y', localtime())
+                self.log_writer.write(path, unescape(header))
+
+            if line is None:
+                line = unescape(output)
+            self.log_writer.write(path, line)
 
     def nick_color(self, nickhost):
         nick = nickhost.split('!')[0]
@@ -490,95 +605,85 @@ def hide_pw_if_necessary(msg, command_char="'"):
     return ' '.join(msg_parts)
 
 
-def display_unescape(in_str):
-    output = ''
-    while in_str != '':
-        if in_str[0] == '$':
-            if len(in_str) > 1 and in_str[1] == '$':
-                in_str = in_str[2:]
-                output += '$'
-            elif len(in_str) > 1 and in_str[1] == '{':
-                arg, in_str = in_str.split('}', 1)
-                output += '!!ARGUMENT{}!!'.format(arg)
-            elif len(in_str) > 1 and in_str[1] == 'c':
-                fore = ''
-                back = ''
-                in_str = in_str[2:]
-                in_fore = True
-
-                if len(in_str) and in_str.startswith('['):
-                    in_str = in_str[1:]
-                    colorstr, in_str = in_str.split(']', 1)
-
-                    colors = colorstr.split(',')
-
-                    if len(colors) and colors[0]:
-                        fore = colour_name_to_code[colors.pop(0)]
-                        if len(colors) and colors[0]:
-                            back = colour_name_to_code[colors.pop(0)]
-                else:
-                    while True:
-                        if len(in_str) > 0 and in_str[0] in '1234567890':
-                            digit = in_str[0]
-                            in_str = in_str[1:]
-
-                            if in_fore:
-                                if len(fore) < 2:
-                                    fore += digit
-                                else:
-                                    in_str = digit + in_str
-                                    break
-                            else:
-                                if len(back) < 2:
-                                    back += digit
-                                else:
-                                    in_str = digit + in_str
-                                    break
-
-                        elif len(in_str) > 0 and in_str[0] == ',':
-                            if in_fore:
-                                in_str = in_str[1:]
-                                in_fore = False
-                            else:
-                                break
-
-                        else:
-                            break
-
-                if fore != '':
-                    if int(fore) > 15:
-                        while int(fore) > 15:
-                            fore = str(int(fore) - 14)
-                    output += fore_colors[str(int(fore))]
-                    if back != '':
-                        if int(back) > 15:
-                            while int(back) > 15:
-                                back = str(int(back) - 14)
-                        output += back_colors[str(int(back))]
+# matches, in order: ${argument}, $c[fore,back], $c<fore>,<back>, $<char> and a lone
+#   trailing $
+display_code_regex = re.compile(r'(\$\{[^}]*)\}'
+                                r'|\$(?:c(?:\[([^\]]*)\]|(\d{0,2})(?:,(\d{0,2}))?)|(.)|$)',
+                                re.DOTALL)
 
-                else:
-                    output += colorama.Fore.RESET + colorama.Back.RESET + colorama.Style.NORMAL
+# code -> ansi escape, filled in as we see new codes
+display_code_cache = {}
+display_code_cache_max = 2048
 
-            elif len(in_str) > 1 and in_str[1] == 'r':
-                output += colorama.Fore.RESET + colorama.Back.RESET + colorama.Style.NORMAL
-                in_str = in_str[2:]
+reset_code = colorama.Fore.RESET + colorama.Back.RESET + colorama.Style.NORMAL
 
-            elif len(in_str) > 1 and in_str[1] in ['b', 'i', 'u']:
-                in_str = in_str[2:]
 
-            elif len(in_str) >= 2:
-                in_str = in_str[2:]
+def _colour_number(code):
+    number = int(code)
+    while number > 15:
+        number -= 14
+    return str(number)
 
-        elif len(in_str) > 0:
-            output += in_str[0]
-            if len(in_str) > 0:
-                in_str = in_str[1:]
 
-        else:
-            break
+def _render_display_code(match):
+    argument, names, fore, back, char = match.groups()
+
+    if argument is not None:
+        return '!!ARGUMENT{}!!'.format(argument)
+
+    if names is not None:
+        fore = back = ''
+        colors = names.split(',')
+        if colors[0]:
+            fore = colour_name_to_code[colors[0]]
+            if len(colors) > 1 and colors[1]:
+                back = colour_name_to_code[colors[1]]
+
+    if fore is not None:
+        if fore == '':
+            return reset_code
+        output = fore_colors[_colour_number(fore)]
+        if back:
+            output += back_colors[_colour_number(back)]
+        return output
 
+    if char == '$' or char is None:
+        return '$'
+    elif char == 'r':
+        return reset_code
+
+    # bold, italic, underline and anything else we don't display
+    return ''
+
+
+def _display_code(match):
+    code = match.group(0)
+    output = display_code_cache.get(code)
+    if output is None:
+        output = _render_display_code(match)
+        if match.group(1) is None and len(display_code_cache) < display_code_cache_max:
+            display_code_cache[code] = output
     return output
 
+
+def display_unescape(in_str):
+    """Turn our $-escaped formatting codes into terminal colours, in a single pass."""
+    return display_code_regex.sub(_display_code, in_str)
+
+
+def benchmark_display_unescape(line_length=400, lines=10000):
+    """Time display_unescape over coloured lines, returns (lines per sec, chars per sec)."""
+    chunk = '$c14[$c12nick$c14]$c $bhello$b $c[red,black]world$r $$5 '
+    line = (chunk * (line_length // len(chunk) + 1))[:line_length]
+
+    start = time.perf_counter()
+    for _ in range(lines):
+        display_unescape(line)
+    elapsed = time.perf_counter() - start
+
+    return lines / elapsed, lines * line_length / elapsed
+
+
 fore_colors = {
     '0': colorama.Fore.WHITE + colorama.Style.NORMAL,
     '1': colorama.Fore.BLACK + colorama.Style.NORMAL,
@@ -635,3 +740,10 @@ back_colors = {
     '14': colorama.Back.LIGHTBLACK_EX,
     '15': colorama.Back.LIGHTWHITE_EX,
 }
+
+
+if __name__ == '__main__':
+    for length in (80, 400, 4000, 40000):
+        lines_per_sec, chars_per_sec = benchmark_display_unescape(length, 400000 // length)
+        print('{:>6} chars/line: {:>10.0f} lines/s {:>12.0f} chars/s'
+              ''.format(length, lines_per_sec, chars_per_sec))
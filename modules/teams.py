@@ -37,12 +37,14 @@ class teams(Module):
 
         if self.store.has_key(['teams', server_name, channel_name, team_slug]):
             if description:
-                self.store.set(['teams', server_name, channel_name, team_slug, 'name'], team_name)
-                self.store.set(['teams', server_name, channel_name, team_slug, 'description'], description)
+                with self.store.batch():
+                    self.store.set(['teams', server_name, channel_name, team_slug, 'name'], team_name)
+                    self.store.set(['teams', server_name, channel_name, team_slug, 'description'], description)
                 event['target'].msg("Updated team's description")
         else:
-            self.store.set(['teams', server_name, channel_name, team_slug, 'name'], team_name)
-            self.store.set(['teams', server_name, channel_name, team_slug, 'description'], description)
+            with self.store.batch():
+                self.store.set(['teams', server_name, channel_name, team_slug, 'name'], team_name)
+                self.store.set(['teams', server_name, channel_name, team_slug, 'description'], description)
             event['target'].msg('Created new team!')
 
     def cmd_deleteteam(self, event, command, usercommand):
@@ -104,14 +106,15 @@ class teams(Module):
 
         joined = False
 
-        if nick not in team_nicks:
-            team_nicks.append(nick)
-            self.store.set(['teams', server_name, channel_name, team_name, 'nicks'], team_nicks)
-            joined = True
-        if userhost not in team_userhosts:
-            team_userhosts.append(userhost)
-            self.store.set(['teams', server_name, channel_name, team_name, 'userhosts'], team_userhosts)
-            joined = True
+        with self.store.batch():
+            if nick not in team_nicks:
+                team_nicks.append(nick)
+                self.store.set(['teams', server_name, channel_name, team_name, 'nicks'], team_nicks)
+                joined = True
+            if userhost not in team_userhosts:
+                team_userhosts.append(userhost)
+                self.store.set(['teams', server_name, channel_name, team_name, 'userhosts'], team_userhosts)
+                joined = True
 
         if joined:
             event['target'].msg('Joined team {chan} / {team}'.format(chan=channel_name, team=team_name))
@@ -141,14 +144,15 @@ class teams(Module):
 
         left = False
 
-        if nick in team_nicks:
-            team_nicks.remove(nick)
-            self.store.set(['teams', server_name, channel_name, team_name, 'nicks'], team_nicks)
-            left = True
-        if userhost in team_userhosts:
-            team_userhosts.remove(userhost)
-            self.store.set(['teams', server_name, channel_name, team_name, 'userhosts'], team_userhosts)
-            left = True
+        with self.store.batch():
+            if nick in team_nicks:
+                team_nicks.remove(nick)
+                self.store.set(['teams', server_name, channel_name, team_name, 'nicks'], team_nicks)
+                left = True
+            if userhost in team_userhosts:
+                team_userhosts.remove(userhost)
+                self.store.set(['teams', server_name, channel_name, team_name, 'userhosts'], team_userhosts)
+                left = True
 
         if left:
             event['target'].msg('Left team {chan} / {team}'.format(chan=channel_name, team=team_name))
@@ -4,10 +4,11 @@
 # licensed under the ISC license
 
 import json
-import urllib.request, urllib.parse, urllib.error
+import urllib.parse
 
 from girc.formatting import escape, unescape
 
+from gbot.libs.helper import get_url
 from gbot.modules import Module
 
 
@@ -21,17 +22,17 @@ class urbandictionary(Module):
         """
         encoded_query = urllib.parse.urlencode({b'term': unescape(usercommand.arguments)})
         url = 'http://www.urbandictionary.com/iphone/search/define?%s' % (encoded_query)
-        try:
-            search_results = urllib.request.urlopen(url)
-            json_result = json.loads(search_results.read().decode('utf-8'))
+        r = get_url(url)
+        if isinstance(r, str):
+            url_result = r
+        else:
             try:
+                json_result = json.loads(r.text)
                 url_result = escape(str(json_result['list'][0]['word'])).replace('\r', '').replace('\n', ' ').strip()
                 url_result += ' --- '
                 url_result += escape(str(json_result['list'][0]['definition'])).replace('\r', '').replace('\n', ' ').strip()
             except:
                 url_result = 'No Results'
-        except urllib.error.URLError:
-            url_result = 'Connection Error'
 
         response = '*** UrbanDictionary: ' + url_result
 